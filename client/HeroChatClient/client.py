@@ -37,7 +37,7 @@ def arg_parser():
     client_passwd = namespace.password
     if not 1023 < server_port < 65536:
         logger.critical(
-            f'Попытка запуска клиента с неподходящим номером порта: {server_port}. Допустимы адреса с 1024 до 65535. Клиент завершается.')
+            'Попытка запуска клиента с неподходящим номером порта: %s. Допустимы адреса с 1024 до 65535. Клиент завершается.', server_port)
         exit(1)
     return server_address, server_port, client_name, client_passwd
 
@@ -54,7 +54,7 @@ if __name__ == '__main__':
         else:
             exit(0)
     logger.info(
-        f'Application is running with arguments: server address: {server_address}, port: {server_port}, username: {client_name}')
+        'Application is running with arguments: server address: %s, port: %s, username: %s', server_address, server_port, client_name)
 
     dir_path = os.path.dirname(os.path.realpath(__file__))
     key_file = os.path.join(dir_path, f'{client_name}.key')
@@ -72,14 +72,17 @@ if __name__ == '__main__':
     except ServerError as error:
         print(error.text)
         exit(1)
-    transport.setDaemon(True)
-    transport.start()
 
     del start_dialog
 
     main_window = ClientMainWindow(database, transport, keys)
     main_window.make_connection(transport)
+    # Thread is started after signals are connected, so messages received
+    # during connection are passed to main window.
+    transport.setDaemon(True)
+    transport.start()
     main_window.setWindowTitle(f'HeroChat - {client_name}')
     client_app.exec_()
+    database.commit_messages()
     transport.transport_shutdown()
     transport.join()
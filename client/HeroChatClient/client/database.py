@@ -1,9 +1,12 @@
 """This file contains database classes and functions for client."""
 
-from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime
+from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime, Index, tuple_, literal, \
+    event, inspect, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import mapper, sessionmaker
 import os
 import sys
+import time
 import datetime
 from common.variables import *
 
@@ -37,6 +40,7 @@ class ClientDatabase:
         filename = f'client_{name}.db3'
         self.database_engine = create_engine(f'sqlite:///{os.path.join(path, filename)}', echo=False, pool_recycle=7200,
                                              connect_args={'check_same_thread': False})
+        event.listen(self.database_engine, 'connect', self.set_sqlite_pragma)
         self.metadata = MetaData()
 
         users = Table('known_users', self.metadata,
@@ -48,13 +52,15 @@ class ClientDatabase:
                         Column('contact', String),
                         Column('direction', String),
                         Column('message', Text),
-                        Column('date', DateTime))
+                        Column('date', DateTime),
+                        Index('ix_message_history_contact_date', 'contact', 'date'))
 
         contacts = Table('contacts', self.metadata,
                          Column('id', Integer, primary_key=True),
                          Column('name', String, unique=True))
 
         self.metadata.create_all(self.database_engine)
+        self.migrate()
 
         mapper(self.KnownUsers, users)
         mapper(self.MessageHistory, history)
@@ -65,6 +71,53 @@ class ClientDatabase:
         self.session.query(self.Contacts).delete()
         self.session.commit()
 
+        self.pending_messages = 0
+        self.commit_time = time.monotonic()
+
+    @staticmethod
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        """Applies performance settings to every new SQLite connection."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    def migrate(self):
+        """Updates database created by older versions. Creates missing indexes
+        and full-text search index of messages.
+        """
+        with self.database_engine.connect() as connection:
+            version = connection.execute('PRAGMA user_version').scalar()
+            if version < CLIENT_SCHEMA_VERSION:
+                inspector = inspect(connection)
+                for table in self.metadata.sorted_tables:
+                    existing = {index['name'] for index in inspector.get_indexes(table.name)}
+                    for index in table.indexes:
+                        if index.name not in existing:
+                            index.create(connection)
+                self.create_search_index(connection)
+                connection.execute(f'PRAGMA user_version={CLIENT_SCHEMA_VERSION}')
+            self.search_enabled = bool(connection.execute(
+                "SELECT count(*) FROM sqlite_master WHERE name = 'message_search'").scalar())
+
+    @staticmethod
+    def create_search_index(connection):
+        """Creates FTS5 index of message texts. Triggers keep it up to date,
+        messages saved before are indexed at once. Nothing is done if SQLite is built without FTS5.
+        """
+        with connection.begin():
+            try:
+                connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS message_search "
+                                   "USING fts5(message, content='message_history', content_rowid='id')")
+            except OperationalError:
+                return
+            connection.execute("CREATE TRIGGER IF NOT EXISTS message_search_insert AFTER INSERT ON message_history "
+                               "BEGIN INSERT INTO message_search(rowid, message) VALUES (new.id, new.message); END")
+            connection.execute("CREATE TRIGGER IF NOT EXISTS message_search_delete AFTER DELETE ON message_history "
+                               "BEGIN INSERT INTO message_search(message_search, rowid, message) "
+                               "VALUES ('delete', old.id, old.message); END")
+            connection.execute("INSERT INTO message_search(message_search) VALUES ('rebuild')")
+
     def add_contact(self, contact):
         """Function for add_contact"""
         if not self.session.query(self.Contacts).filter_by(name=contact).count():
@@ -85,10 +138,25 @@ class ClientDatabase:
         self.session.commit()
 
     def save_message(self, contact, direction, message):
-        """Message saving function."""
+        """Message saving function. Returns date of saved message.
+        Messages of a burst are committed together: commit is made for
+        MESSAGES_COMMIT_SIZE messages or if there was no commit for
+        MESSAGES_COMMIT_INTERVAL seconds. The rest is saved by 'commit_messages'.
+        """
         message_row = self.MessageHistory(contact, direction, message)
         self.session.add(message_row)
-        self.session.commit()
+        self.pending_messages += 1
+        if self.pending_messages >= MESSAGES_COMMIT_SIZE \
+                or time.monotonic() - self.commit_time >= MESSAGES_COMMIT_INTERVAL:
+            self.commit_messages()
+        return message_row.date
+
+    def commit_messages(self):
+        """Commits saved messages."""
+        if self.pending_messages:
+            self.session.commit()
+        self.pending_messages = 0
+        self.commit_time = time.monotonic()
 
     def get_contacts(self):
         """Get contact function. Returns contact object."""
@@ -113,6 +181,90 @@ class ClientDatabase:
 
     def get_history(self, contact):
         """Updating message history for chosen user."""
-        query = self.session.query(self.MessageHistory).filter_by(contact=contact)
-        return [(history_row.contact, history_row.direction, history_row.message, history_row.date)
-                for history_row in query.all()]
+        history = self.MessageHistory
+        query = self.session.query(history.contact, history.direction, history.message, history.date). \
+            filter(history.contact == contact).order_by(history.date)
+        return [tuple(row) for row in query.all()]
+
+    def get_history_page(self, contact, before=None, limit=HISTORY_PAGE_SIZE):
+        """Returns 'limit' newest messages with contact which are older than 'before',
+        (date, id) of the oldest loaded message. Newest messages are returned if 'before' is None.
+        Rows (id, direction, message, date) are in chronological order.
+        """
+        history = self.MessageHistory
+        query = self.session.query(history.id, history.direction, history.message, history.date). \
+            filter(history.contact == contact)
+        if before:
+            query = query.filter(tuple_(history.date, history.id) <
+                                 tuple_(literal(before[0], DateTime), literal(before[1], Integer)))
+        rows = query.order_by(history.date.desc(), history.id.desc()).limit(limit).all()
+        rows.reverse()
+        return rows
+
+
+    def search_messages(self, query, limit=SEARCH_RESULTS_LIMIT):
+        """Full-text search in message history, every word of query must be found.
+        SEARCH_RANK_WINDOW newest matches are ranked, so search of common word
+        does not rank the whole history. Returns best matches first:
+        (contact, direction, snippet with found words in brackets, date).
+        """
+        words = query.split()
+        if not words:
+            return []
+        self.session.flush()
+        if not self.search_enabled:
+            history = self.MessageHistory
+            rows = self.session.query(history.contact, history.direction, history.message, history.date). \
+                filter(history.message.contains(query.strip())).order_by(history.date.desc()).limit(limit)
+            return [tuple(row) for row in rows]
+        # Words are quoted, so symbols of FTS5 query syntax are searched as text.
+        match = ' '.join('"{}"'.format(word.replace('"', '""')) for word in words)
+        oldest = self.session.execute(
+            "SELECT rowid FROM message_search WHERE message_search MATCH :match "
+            "ORDER BY rowid DESC LIMIT 1 OFFSET :window",
+            {'match': match, 'window': SEARCH_RANK_WINDOW}).scalar()
+        statement = text(
+            "SELECT message_history.contact, message_history.direction, "
+            "snippet(message_search, 0, '[', ']', '...', 10) AS snippet, message_history.date "
+            "FROM message_search JOIN message_history ON message_history.id = message_search.rowid "
+            "WHERE message_search MATCH :match AND message_search.rowid >= :oldest "
+            "ORDER BY bm25(message_search) LIMIT :limit"
+        ).columns(contact=String, direction=String, snippet=Text, date=DateTime)
+        rows = self.session.execute(statement, {'match': match, 'oldest': oldest or 0, 'limit': limit})
+        return [tuple(row) for row in rows]
+
+if __name__ == '__main__':
+    # History queries on 1M messages with 1000 contacts, with and without index,
+    # full-text search and burst saving speed.
+    import timeit
+
+    bench_database = ClientDatabase('benchmark')
+    history_table = bench_database.metadata.tables['message_history']
+    if not bench_database.session.query(bench_database.MessageHistory.id).first():
+        start_date = datetime.datetime(2020, 1, 1)
+        bench_database.session.execute(
+            history_table.insert(),
+            [{'contact': f'user_{i % 1000}', 'direction': 'in', 'message': f'message {i} about topic{i % 5000}',
+              'date': start_date + datetime.timedelta(seconds=i)} for i in range(1000000)])
+        bench_database.session.commit()
+    index = next(iter(history_table.indexes))
+    for indexed in (False, True):
+        if indexed:
+            index.create(bench_database.database_engine)
+        else:
+            index.drop(bench_database.database_engine)
+        number = 20
+        history = timeit.timeit(lambda: bench_database.get_history('user_500'), number=number)
+        page = timeit.timeit(lambda: bench_database.get_history_page('user_500'), number=number)
+        print(f'Index {indexed}: get_history {history / number * 1e3:.2f} ms, '
+              f'get_history_page {page / number * 1e3:.2f} ms')
+    for query in ('topic42', 'about topic4', 'message', 'topic42 "missing'):
+        search = timeit.timeit(lambda: bench_database.search_messages(query), number=number)
+        print(f'search_messages {query!r}: {search / number * 1e3:.2f} ms')
+    number = 10000
+    burst = timeit.timeit(lambda: bench_database.save_message('user_1', 'in', 'message text'), number=number)
+    bench_database.commit_messages()
+    print(f'save_message burst: {number / burst:.0f} messages/s')
+    bench_database.session.close()
+    bench_database.database_engine.dispose()
+    os.remove(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'client_benchmark.db3'))
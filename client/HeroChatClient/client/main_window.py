@@ -1,14 +1,12 @@
 """This file contains class for client main window. Based on PyQt5 classes."""
 
 import sys
-import json
 import logging
-import base64
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_OAEP
-from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QListView
+from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QListView, QAbstractItemView
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
-from PyQt5.QtCore import pyqtSlot, QEvent, Qt
+from PyQt5.QtCore import pyqtSlot, QEvent, Qt, QTimer
 from client.main_window_conv import Ui_MainClientWindow
 from client.add_contact import AddContactDialog
 from client.del_contact import DelContactDialog
@@ -24,6 +22,7 @@ from client.transport import ClientTransport
 from client.start_dialog import UserNameDialog
 from common.errors import ServerError
 from common.variables import *
+from common.serializers import binary
 
 
 sys.path.append('../')
@@ -50,14 +49,28 @@ class ClientMainWindow(QMainWindow):
 
         self.contacts_model = None
         self.history_model = None
+        self.history_oldest = None
+        self.history_exhausted = True
         self.messages = QMessageBox()
         self.current_chat = None
         self.current_chat_key = None
         self.encryptor = None
         self.ui.list_messages.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.ui.list_messages.setWordWrap(True)
+        self.ui.list_messages.verticalScrollBar().valueChanged.connect(self.history_scrolled)
 
         self.ui.list_contacts.doubleClicked.connect(self.select_active_user)
+        self.search_model = QStandardItemModel()
+        self.ui.list_search.setModel(self.search_model)
+        self.ui.list_search.setWordWrap(True)
+        self.ui.list_search.hide()
+        self.ui.list_search.doubleClicked.connect(self.select_search_result)
+        self.ui.line_search.returnPressed.connect(self.search_messages)
+        self.ui.line_search.textChanged.connect(self.search_text_changed)
+        # Saves the rest of incoming messages burst.
+        self.commit_timer = QTimer(self)
+        self.commit_timer.timeout.connect(self.database.commit_messages)
+        self.commit_timer.start(MESSAGES_COMMIT_INTERVAL * 1000)
         self.clients_list_update()
         self.set_disabled_input()
         self.show()
@@ -66,6 +79,7 @@ class ClientMainWindow(QMainWindow):
         """Based function to disable input area while contact isn't chosen."""
         self.ui.label_new_message.setText('Double click on name will choose user')
         self.ui.text_message.clear()
+        self.history_exhausted = True
         if self.history_model:
             self.history_model.clear()
         self.ui.btn_send.setDisabled(True)
@@ -77,32 +91,57 @@ class ClientMainWindow(QMainWindow):
         self.current_chat_key = None
 
     def history_list_update(self):
-        """Updating history function."""
-        list = sorted(self.database.get_history(self.current_chat), key=lambda item: item[3])
+        """Loads the newest page of history with chosen user."""
         if not self.history_model:
             self.history_model = QStandardItemModel()
             self.ui.list_messages.setModel(self.history_model)
+        self.history_exhausted = True
         self.history_model.clear()
-        length = len(list)
-        start_index = 0
-        if length > 20:
-            start_index = length - 20
-        for i in range(start_index, length):
-            item = list[i]
-            if item[1] == 'in':
-                mess = QStandardItem(f'Incoming message {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setBackground(QBrush(QColor(255, 213, 213)))
-                mess.setTextAlignment(Qt.AlignLeft)
-                self.history_model.appendRow(mess)
-            else:
-                mess = QStandardItem(f'Message from {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setTextAlignment(Qt.AlignRight)
-                mess.setBackground(QBrush(QColor(204, 255, 204)))
-                self.history_model.appendRow(mess)
+        self.history_oldest = None
+        self.load_older_history()
         self.ui.list_messages.scrollToBottom()
 
+    def load_older_history(self):
+        """Inserts page of messages older than loaded ones to the top of list.
+        Returns number of inserted messages.
+        """
+        rows = self.database.get_history_page(self.current_chat, self.history_oldest)
+        # Scroll signals are ignored while rows are inserted.
+        self.history_exhausted = True
+        for row, (message_id, direction, message, date) in enumerate(rows):
+            self.history_model.insertRow(row, self.history_item(direction, message, date))
+        if rows:
+            self.history_oldest = (rows[0][3], rows[0][0])
+        self.history_exhausted = len(rows) < HISTORY_PAGE_SIZE
+        return len(rows)
+
+    def history_scrolled(self, value):
+        """Loads older messages when list is scrolled to the top. Visible messages stay in place."""
+        if value != self.ui.list_messages.verticalScrollBar().minimum() or self.history_exhausted:
+            return
+        loaded = self.load_older_history()
+        if loaded:
+            self.ui.list_messages.scrollTo(self.history_model.index(loaded, 0), QAbstractItemView.PositionAtTop)
+
+    def history_append(self, direction, message, date):
+        """Adds new message to the end of list."""
+        self.history_model.appendRow(self.history_item(direction, message, date))
+        self.ui.list_messages.scrollToBottom()
+
+    @staticmethod
+    def history_item(direction, message, date):
+        """Creates list item for message."""
+        if direction == 'in':
+            item = QStandardItem(f'Incoming message {date.replace(microsecond=0)}:\n {message}')
+            item.setBackground(QBrush(QColor(255, 213, 213)))
+            item.setTextAlignment(Qt.AlignLeft)
+        else:
+            item = QStandardItem(f'Message from {date.replace(microsecond=0)}:\n {message}')
+            item.setTextAlignment(Qt.AlignRight)
+            item.setBackground(QBrush(QColor(204, 255, 204)))
+        item.setEditable(False)
+        return item
+
     def select_active_user(self):
         """Select user function."""
         self.current_chat = self.ui.list_contacts.currentIndex().data()
@@ -113,13 +152,13 @@ class ClientMainWindow(QMainWindow):
          chosen user."""
         try:
             self.current_chat_key = self.transport.key_request(self.current_chat)
-            logger.debug(f'Key has been received for {self.current_chat}')
+            logger.debug('Key has been received for %s', self.current_chat)
             if self.current_chat_key:
                 self.encryptor = PKCS1_OAEP.new(RSA.import_key(self.current_chat_key))
-        except (OSError, json.JSONDecodeError) as ER:
+        except (OSError, ValueError) as ER:
             self.current_chat_key = None
             self.encryptor = None
-            logger.debug(f'Failed to load key. {ER}')
+            logger.debug('Failed to load key. %s', ER)
         if not self.current_chat_key:
             self.messages.warning(self, 'ERROR', "Key for this user doesn't exist")
             return
@@ -130,6 +169,30 @@ class ClientMainWindow(QMainWindow):
         self.ui.text_message.setDisabled(False)
         self.history_list_update()
 
+    def search_messages(self):
+        """Shows messages found by words from search box instead of contacts list."""
+        self.search_model.clear()
+        for contact, direction, snippet, date in self.database.search_messages(self.ui.line_search.text()):
+            title = 'from' if direction == 'in' else 'to'
+            item = QStandardItem(f'{title} {contact} {date.replace(microsecond=0)}:\n {snippet}')
+            item.setData(contact, Qt.UserRole)
+            item.setEditable(False)
+            self.search_model.appendRow(item)
+        self.ui.list_contacts.hide()
+        self.ui.list_search.show()
+
+    def search_text_changed(self, text):
+        """Returns contacts list when search box is cleared."""
+        if not text.strip():
+            self.ui.list_search.hide()
+            self.ui.list_contacts.show()
+
+    def select_search_result(self, index):
+        """Opens chat with contact of found message."""
+        self.current_chat = index.data(Qt.UserRole)
+        self.ui.line_search.clear()
+        self.set_active_user()
+
     def clients_list_update(self):
         """Updating contacts list to table."""
         contacts_list = self.database.get_contacts()
@@ -169,7 +232,7 @@ class ClientMainWindow(QMainWindow):
             new_contact = QStandardItem(new_contact)
             new_contact.setEditable(False)
             self.contacts_model.appendRow(new_contact)
-            logger.info(f'Contact {new_contact} has been added successfully')
+            logger.info('Contact %s has been added successfully', new_contact)
             self.messages.information(self, 'Done', 'Contact has been added successfully')
 
     def delete_contact_window(self):
@@ -194,7 +257,7 @@ class ClientMainWindow(QMainWindow):
         else:
             self.database.del_contact(selected)
             self.clients_list_update()
-            logger.info(f'Contact {selected} has been deleted successfully')
+            logger.info('Contact %s has been deleted successfully', selected)
             self.messages.information(self, 'Done', 'Contact has been deleted successfully')
             item.close()
             if selected == self.current_chat:
@@ -209,10 +272,9 @@ class ClientMainWindow(QMainWindow):
             return
 
         message_text_encrypted = self.encryptor.encrypt(message_text.encode('utf-8'))
-        message_text_encrypted_base64 = base64.b64encode(message_text_encrypted)
 
         try:
-            self.transport.send_message(self.current_chat, message_text_encrypted_base64.decode('ascii'))
+            self.transport.send_message(self.current_chat, message_text_encrypted)
             pass
         except ServerError as err:
             self.messages.critical(self, 'Error', err.text)
@@ -225,23 +287,23 @@ class ClientMainWindow(QMainWindow):
             self.messages.critical(self, 'Error', 'Connection has been lost')
             self.close()
         else:
-            self.database.save_message(self.current_chat, 'out', message_text)
-            logger.debug(f'Message has been send to {self.current_chat}: {message_text}')
-            self.history_list_update()
+            date = self.database.save_message(self.current_chat, 'out', message_text)
+            logger.debug('Message has been send to %s: %s', self.current_chat, message_text)
+            self.history_append('out', message_text, date)
 
-    @pyqtSlot(str)
+    @pyqtSlot(dict)
     def message(self, message):
         """Receive incoming message and decode it."""
-        encrypted_message = base64.b64decode(message[MESSAGE_TEXT])
         try:
-            decrypted_message = self.decrypter.decrypt(encrypted_message)
+            decrypted_message = self.decrypter.decrypt(binary(message[MESSAGE_TEXT]))
         except (ValueError, TypeError) as ER:
             self.messages.warning(self, 'ERROR', 'Failed to decrypt message')
             return
-        self.database.save_message(self.current_chat, 'in', decrypted_message.decode('utf-8'))
         sender = message[SENDER]
+        message_text = decrypted_message.decode('utf-8')
+        date = self.database.save_message(sender, 'in', message_text)
         if sender == self.current_chat:
-            self.history_list_update()
+            self.history_append('in', message_text, date)
         else:
             if self.database.check_contact(sender):
                 if self.messages.question(self, 'New Message',
@@ -266,8 +328,9 @@ class ClientMainWindow(QMainWindow):
         self.close()
 
     @pyqtSlot()
-    def sig_205(self):
-        """Warnings while contact is not online."""
+    def sig_205(self, users):
+        """Saves known users and warns if current contact has been deleted."""
+        self.database.add_users(users)
         if self.current_chat and not self.database.check_user(self.current_chat):
             self.messages.warning(self, 'Sorry', 'User has been deleted from server')
             self.set_disabled_input()
@@ -277,6 +340,7 @@ class ClientMainWindow(QMainWindow):
     def make_connection(self, trans_obj):
         trans_obj.new_message.connect(self.message)
         trans_obj.connection_lost.connect(self.connection_lost)
+        trans_obj.message_205.connect(self.sig_205)
 
 
 
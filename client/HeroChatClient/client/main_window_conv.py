@@ -33,9 +33,15 @@ class Ui_MainClientWindow(object):
         self.label_new_message = QtWidgets.QLabel(self.centralwidget)
         self.label_new_message.setGeometry(QtCore.QRect(300, 330, 450, 16)) # Правка тут
         self.label_new_message.setObjectName("label_new_message")
+        self.line_search = QtWidgets.QLineEdit(self.centralwidget)
+        self.line_search.setGeometry(QtCore.QRect(10, 20, 251, 25))
+        self.line_search.setObjectName("line_search")
         self.list_contacts = QtWidgets.QListView(self.centralwidget)
-        self.list_contacts.setGeometry(QtCore.QRect(10, 20, 251, 411))
+        self.list_contacts.setGeometry(QtCore.QRect(10, 50, 251, 381))
         self.list_contacts.setObjectName("list_contacts")
+        self.list_search = QtWidgets.QListView(self.centralwidget)
+        self.list_search.setGeometry(QtCore.QRect(10, 50, 251, 381))
+        self.list_search.setObjectName("list_search")
         self.list_messages = QtWidgets.QListView(self.centralwidget)
         self.list_messages.setGeometry(QtCore.QRect(300, 20, 441, 301))
         self.list_messages.setObjectName("list_messages")
@@ -81,6 +87,7 @@ class Ui_MainClientWindow(object):
         self.btn_add_contact.setText(_translate("MainClientWindow", "Add contact"))
         self.btn_remove_contact.setText(_translate("MainClientWindow", "Delete contact"))
         self.label_history.setText(_translate("MainClientWindow", "Message history"))
+        self.line_search.setPlaceholderText(_translate("MainClientWindow", "Search messages"))
         self.label_new_message.setText(_translate("MainClientWindow", "Enter your message:"))
         self.btn_send.setText(_translate("MainClientWindow", "Send message"))
         self.btn_clear.setText(_translate("MainClientWindow", "Clear"))
@@ -3,17 +3,20 @@
 import socket
 import sys
 import time
+import errno
 import logging
-import json
 import threading
+import itertools
 import binascii
 import hashlib
 import hmac
+from concurrent import futures
 
 from PyQt5.QtCore import pyqtSignal, QObject
 from common.utils import *
 from common.variables import *
 from common.errors import ServerError
+from common.serializers import AVAILABLE_CODECS, JSON_CODEC
 
 sys.path.append('../')
 logger = logging.getLogger('client')
@@ -21,9 +24,12 @@ socket_lock = threading.Lock()
 
 
 class ClientTransport(threading.Thread, QObject):
-    """Creates basic threads, socket objects. """
-    new_message = pyqtSignal(str)
-    message_205 = pyqtSignal()
+    """Client connection. Thread of transport reads all messages from server:
+    responses are matched to requests by request id, messages pushed
+    by server are passed to signals. Requests are sent from caller thread.
+    """
+    new_message = pyqtSignal(dict)
+    message_205 = pyqtSignal(list)
     connection_lost = pyqtSignal()
 
     def __init__(self, port, ip_address, database, username, passwd, keys):
@@ -34,6 +40,12 @@ class ClientTransport(threading.Thread, QObject):
         self.password = passwd
         self.keys = keys
         self.transport = None
+        self.request_ids = itertools.count(1)
+        self.window = threading.BoundedSemaphore(REQUEST_WINDOW)
+        self.pending = dict()
+        self.reading = False
+        self.deferred = []
+        self.running = False
         self.connection_init(port, ip_address)
         try:
             self.user_list_update()
@@ -41,11 +53,11 @@ class ClientTransport(threading.Thread, QObject):
         except OSError as err:
             if err.errno:
                 print(err)
-                logger.critical(f'Connection has been lost.')
+                logger.critical('Connection has been lost.')
                 raise ServerError('Connection has been lost')
             logger.error('Timeout connection while refreshing contact list.')
-        except json.JSONDecodeError:
-            logger.critical(f'Connection has been lost')
+        except ValueError:
+            logger.critical('Connection has been lost')
             raise ServerError('Connection has been lost')
         except Exception as b:
             print(b)
@@ -57,7 +69,7 @@ class ClientTransport(threading.Thread, QObject):
         self.transport.settimeout(5)
         connected = False
         for i in range(5):
-            logger.info(f'Connection attempt №{i + 1}')
+            logger.info('Connection attempt №%s', i + 1)
             try:
                 self.transport.connect((ip, port))
             except (OSError, ConnectionRefusedError):
@@ -85,58 +97,112 @@ class ClientTransport(threading.Thread, QObject):
                     raise ServerError(ans[ERROR])
                 elif ans[RESPONSE] == 511:
                     ans_data = ans[DATA]
-                    hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'))
+                    hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'), hashlib.md5)
                     digest = hash.digest()
-                    my_ans = RESPONSE_511
-                    my_ans[DATA] = binascii.b2a_base64(digest).decode('ascii')
-                    send_message(self.transport, my_ans)
-                    self.process_server_ans(get_message(self.transport))
-            except (OSError, json.JSONDecodeError):
+                    set_socket_codec(self.transport, AVAILABLE_CODECS.get(ans.get(CODEC), JSON_CODEC))
+                    send_message(self.transport, data_response(digest))
+                    self.check_answer(get_message(self.transport))
+            except (OSError, ValueError):
                 logger.critical('Connection has been lost')
                 raise ServerError('Connection has been lost')
         logger.info('Connection to server successfully')
 
     def create_presence(self, pubkey):
-        """Creates presence message and crypt key"""
+        """Creates presence message and crypt key. Message contains codecs
+        which client can use, server chooses one of them in answer.
+        """
         out = {
             ACTION: PRESENCE,
             TIME: time.time(),
             USER: {
                 ACCOUNT_NAME: self.username,
                 PUBLIC_KEY: pubkey
-            }
+            },
+            CODECS: list(AVAILABLE_CODECS)
         }
-        logger.debug(f'Created {PRESENCE} message for user {self.username}')
+        logger.debug('Created %s message for user %s', PRESENCE, self.username)
         return out
 
+    def check_answer(self, answer):
+        """Raises ServerError if server has rejected request."""
+        if answer[RESPONSE] == 400:
+            raise ServerError(f'{answer[ERROR]}')
+        elif answer[RESPONSE] != 200:
+            logger.debug('Received unknown code %s', answer[RESPONSE])
+
     def process_server_ans(self, message):
-        """Parsing answer from server. """
-        logger.debug(f'Checking server message: {message}')
+        """Routes message from server: response completes future of request
+        with the same id, messages pushed by server are passed to signals.
+        """
+        logger.debug('Checking server message: %s', message)
         if RESPONSE in message:
-            if message[RESPONSE] == 200:
-                return
-            elif message[RESPONSE] == 400:
-                raise ServerError(f'{message[ERROR]}')
+            future = self.pending.pop(message.get(REQUEST_ID), None)
+            if future:
+                future.set_result(message)
+            elif message[RESPONSE] == 205:
+                self.push(self.users_changed)
             else:
-                logger.debug(f'Received unknown code {message[RESPONSE]}')
+                logger.debug('Response to unknown request: %s', message)
         elif ACTION in message and message[ACTION] == MESSAGE and SENDER in message and DESTINATION in message \
                 and MESSAGE_TEXT in message and message[DESTINATION] == self.username:
-            logger.debug(f'Message from {message[SENDER]}:{message[MESSAGE_TEXT]}')
-            self.database.save_message(message[SENDER], 'in', message[MESSAGE_TEXT])
-            self.new_message.emit(message[SENDER])
+            logger.debug('Message from %s', message[SENDER])
+            self.push(self.new_message.emit, message)
+
+    def push(self, handler, *args):
+        """Handles message pushed by server. Messages received while
+        transport is created are handled when its thread starts.
+        """
+        if self.reading:
+            handler(*args)
+        else:
+            self.deferred.append((handler, args))
+
+    def request(self, message, window=True):
+        """Sends request with new id. Returns Future which gets response with the same id.
+        Requests are not waiting for each other, but no more than REQUEST_WINDOW
+        of them wait for response: next request waits for free place in window.
+        Reader thread sends requests out of window, so it never waits.
+        """
+        if window and not self.window.acquire(timeout=RESPONSE_TIMEOUT):
+            raise socket.timeout('Server response timeout')
+        future = futures.Future()
+        if window:
+            future.add_done_callback(lambda done: self.window.release())
+        with socket_lock:
+            try:
+                if self.reading and not self.running:
+                    raise ConnectionResetError(errno.ECONNRESET, 'Connection has been lost')
+                request_id = next(self.request_ids)
+                message[REQUEST_ID] = request_id
+                self.pending[request_id] = future
+                send_message(self.transport, message)
+            except OSError:
+                self.pending.pop(message.get(REQUEST_ID), None)
+                future.cancel()
+                raise
+        return future
+
+    def get_response(self, future):
+        """Waits for response to request. Until thread of transport
+        is started messages are read here.
+        """
+        while not self.reading and not future.done():
+            self.process_server_ans(get_message(self.transport))
+        try:
+            return future.result(RESPONSE_TIMEOUT)
+        except futures.TimeoutError:
+            raise socket.timeout('Server response timeout')
 
     def contacts_list_update(self):
         """Creates message to request contacts from server and parses answer."""
-        logger.debug(f'Requesting contact list for {self.name}')
+        logger.debug('Requesting contact list for %s', self.name)
         req = {
             ACTION: GET_CONTACTS,
             TIME: time.time(),
             USER: self.username}
-        logger.debug(f'Request created {req}')
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
-        logger.debug(f'Answer received {ans}')
+        logger.debug('Request created %s', req)
+        ans = self.get_response(self.request(req))
+        logger.debug('Answer received %s', ans)
         if RESPONSE in ans and ans[RESPONSE] == 202:
             for contact in ans[LIST_INFO]:
                 self.database.add_contact(contact)
@@ -145,15 +211,13 @@ class ClientTransport(threading.Thread, QObject):
 
     def user_list_update(self):
         """Creates message to refresh known users. Parses the answer."""
-        logger.debug(f'Request to refresh known users {self.username}')
+        logger.debug('Request to refresh known users %s', self.username)
         req = {
             ACTION: USERS_REQUEST,
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.get_response(self.request(req))
         if RESPONSE in ans and ans[RESPONSE] == 202:
             self.database.add_users(ans[LIST_INFO])
         else:
@@ -161,45 +225,41 @@ class ClientTransport(threading.Thread, QObject):
 
     def key_request(self, user):
         """Tries to request crypt key from server"""
-        logger.debug(f'Request key for {user}')
+        logger.debug('Request key for %s', user)
         request = {ACTION: PUBLIC_KEY_REQUEST,
                    TIME: time.time(),
                    ACCOUNT_NAME: user}
-        with socket_lock:
-            send_message(self.transport, request)
-            answer = get_message(self.transport)
+        answer = self.get_response(self.request(request))
         if RESPONSE in answer and answer[RESPONSE] == 511:
             return answer[DATA]
         else:
-            logger.error(f'Failed to load key from {user}')
+            logger.error('Failed to load key from %s', user)
 
     def add_contact(self, contact):
         """Creates message to add contact."""
-        logger.debug(f'Creating contact {contact}')
+        logger.debug('Creating contact %s', contact)
         req = {
             ACTION: ADD_CONTACT,
             TIME: time.time(),
             USER: self.username,
             ACCOUNT_NAME: contact}
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.check_answer(self.get_response(self.request(req)))
 
     def remove_contact(self, contact):
         """Creates message to delete contact."""
-        logger.debug(f'Deleting contact {contact}')
+        logger.debug('Deleting contact %s', contact)
         req = {
             ACTION: REMOVE_CONTACT,
             TIME: time.time(),
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.check_answer(self.get_response(self.request(req)))
 
     def transport_shutdown(self):
-        """Exit function. Creates quit message."""
+        """Exit function. Sends quit message and closes connection,
+        so thread of transport is finished.
+        """
         self.running = False
         message = {
             ACTION: EXIT,
@@ -209,13 +269,13 @@ class ClientTransport(threading.Thread, QObject):
         with socket_lock:
             try:
                 send_message(self.transport, message)
+                self.transport.shutdown(socket.SHUT_RDWR)
             except OSError:
                 pass
         logger.debug('Application shutdown')
-        time.sleep(0.5)
 
-    def send_message(self, to, message):
-        """Creates message to server that tries send message to user."""
+    def create_message(self, to, message):
+        """Creates message to user. Encrypted message is passed as bytes."""
         message_dict = {
             ACTION: MESSAGE,
             SENDER: self.username,
@@ -223,32 +283,87 @@ class ClientTransport(threading.Thread, QObject):
             TIME: time.time(),
             MESSAGE_TEXT: message
         }
-        logger.debug(f'Message dict has created: {message_dict}')
-        with socket_lock:
-            send_message(self.transport, message_dict)
-            self.process_server_ans(get_message(self.transport))
-            logger.info(f'Message to {to} has been send')
+        logger.debug('Message dict has created: %s', message_dict)
+        return message_dict
+
+    def send_message(self, to, message):
+        """Creates message to server that tries send message to user.
+        Encrypted message is passed as bytes.
+        """
+        self.check_answer(self.get_response(self.request(self.create_message(to, message))))
+        logger.info('Message to %s has been send', to)
+
+    def send_messages(self, messages):
+        """Sends list of (user, encrypted message) without waiting for response
+        to every message. Returns futures of responses in order of messages.
+        """
+        return [self.request(self.create_message(to, message)) for to, message in messages]
+
+    def send_message_batch(self, messages):
+        """Sends list of (user, encrypted message) in one MESSAGE_BATCH request.
+        Returns list of statuses: 200 if message is accepted, 400 if not.
+        """
+        request = {
+            ACTION: MESSAGE_BATCH,
+            SENDER: self.username,
+            TIME: time.time(),
+            MESSAGES: [[to, message] for to, message in messages]
+        }
+        answer = self.get_response(self.request(request))
+        self.check_answer(answer)
+        logger.info('Batch of %s messages has been send', len(messages))
+        return answer[LIST_INFO]
+
+    def users_changed(self):
+        """Requests known users after server has reported changes (205).
+        Reader thread does not wait for response.
+        """
+        request = {
+            ACTION: USERS_REQUEST,
+            TIME: time.time(),
+            ACCOUNT_NAME: self.username
+        }
+        try:
+            self.request(request, window=False).add_done_callback(self.users_received)
+        except OSError:
+            logger.error('Failed to refresh know users.')
+
+    def users_received(self, future):
+        """Passes known users from response to main window, which saves them
+        in database: session of database belongs to GUI thread.
+        """
+        if future.cancelled() or future.exception():
+            return
+        answer = future.result()
+        if RESPONSE in answer and answer[RESPONSE] == 202:
+            self.message_205.emit(answer[LIST_INFO])
+        else:
+            logger.error('Failed to refresh know users.')
 
     def run(self):
-        """Base function that runs application."""
+        """Reads messages from server until connection is closed. Socket is read
+        without timeout, so messages are handled as soon as they arrive.
+        """
         logger.debug('Process receive messages is running.')
+        self.transport.settimeout(None)
+        self.reading = True
+        for handler, args in self.deferred:
+            handler(*args)
+        self.deferred = []
         while self.running:
-            time.sleep(1)
-            with socket_lock:
-                try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        logger.critical(f'Connection has been lost.')
-                        self.running = False
-                        self.connection_lost.emit()
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError, TypeError):
-                    logger.debug(f'Connection has been lost')
-                    self.running = False
-                    self.connection_lost.emit()
-                else:
-                    logger.debug(f'Message from server: {message}')
-                    self.process_server_ans(message)
-                finally:
-                    self.transport.settimeout(5)
+            try:
+                message = get_message(self.transport)
+            except (OSError, ValueError, TypeError):
+                break
+            self.process_server_ans(message)
+        lost = self.running
+        with socket_lock:
+            self.running = False
+        error = ConnectionResetError(errno.ECONNRESET, 'Connection has been lost')
+        for request_id in list(self.pending):
+            future = self.pending.pop(request_id, None)
+            if future:
+                future.set_exception(error)
+        if lost:
+            logger.critical('Connection has been lost.')
+            self.connection_lost.emit()
@@ -0,0 +1,86 @@
+"""File contains codecs for message frame body. Codec of connection is chosen
+during PRESENCE/511 handshake, JSON is used until then and for old clients.
+"""
+
+import binascii
+import json
+from common.variables import ENCODING
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    """JSON codec. Binary values are sent as base64 strings."""
+    name = 'json'
+
+    def encode(self, message):
+        return json.dumps(message, default=self.binary_to_text).encode(ENCODING)
+
+    def decode(self, data):
+        return json.loads(data.decode(ENCODING))
+
+    @staticmethod
+    def binary_to_text(value):
+        if isinstance(value, (bytes, bytearray)):
+            return binascii.b2a_base64(value, newline=False).decode('ascii')
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class MsgpackCodec:
+    """MessagePack codec. Binary values are sent as raw bytes."""
+    name = 'msgpack'
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+JSON_CODEC = JsonCodec()
+# Codecs in order of preference. MessagePack is used only if module is installed.
+AVAILABLE_CODECS = {MsgpackCodec.name: MsgpackCodec()} if msgpack else {}
+AVAILABLE_CODECS[JSON_CODEC.name] = JSON_CODEC
+
+
+def choose_codec(names):
+    """Returns first codec from client list which is available. JSON by default."""
+    if isinstance(names, list):
+        for name in names:
+            if isinstance(name, str) and name in AVAILABLE_CODECS:
+                return AVAILABLE_CODECS[name]
+    return JSON_CODEC
+
+
+def binary(value):
+    """Returns bytes of binary field. Base64 string is decoded."""
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return binascii.a2b_base64(value)
+
+
+def text(value):
+    """Returns binary field as base64 string. Strings are returned as is."""
+    if isinstance(value, (bytes, bytearray)):
+        return JsonCodec.binary_to_text(value)
+    return value
+
+
+if __name__ == '__main__':
+    # Encode/decode speed and frame body size of chat message for every codec.
+    import os
+    import timeit
+    from common.variables import ACTION, MESSAGE, SENDER, DESTINATION, TIME, MESSAGE_TEXT
+
+    bench_message = {ACTION: MESSAGE, SENDER: 'user_1', DESTINATION: 'user_2',
+                     TIME: 1600000000.0, MESSAGE_TEXT: os.urandom(256)}
+    number = 100000
+    for codec in AVAILABLE_CODECS.values():
+        data = codec.encode(bench_message)
+        encode = timeit.timeit(lambda: codec.encode(bench_message), number=number)
+        decode = timeit.timeit(lambda: codec.decode(data), number=number)
+        print(f'{codec.name}: {len(data)} bytes, encode {number / encode:.0f} msg/s, '
+              f'decode {number / decode:.0f} msg/s')
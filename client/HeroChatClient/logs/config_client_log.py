@@ -5,6 +5,7 @@ import sys
 import os
 import logging
 from common.variables import LOGGING_LEVEL
+from logs.log_queue import start_queue_logging
 
 sys.path.append('../')
 client_formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(message)s')
@@ -16,8 +17,7 @@ steam.setLevel(logging.ERROR)
 log_file = logging.FileHandler(path, encoding='utf8')
 log_file.setFormatter(client_formatter)
 logger = logging.getLogger('client')
-logger.addHandler(steam)
-logger.addHandler(log_file)
+queue_handler, listener = start_queue_logging(logger, steam, log_file)
 logger.setLevel(LOGGING_LEVEL)
 
 if __name__ == '__main__':
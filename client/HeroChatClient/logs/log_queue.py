@@ -0,0 +1,56 @@
+"""File contains asynchronous logging pipeline. Records are put to bounded queue
+by QueueHandler and written to real handlers by QueueListener in background thread.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+from common.variables import LOG_QUEUE_SIZE
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler which never blocks logging thread. When queue is full
+    DEBUG and INFO records are dropped, records of WARNING level and above
+    replace the oldest queued record. Number of lost records is kept in dropped.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        self.dropped += 1
+        if record.levelno < logging.WARNING:
+            return
+        try:
+            self.queue.get_nowait()
+            self.queue.put_nowait(record)
+        except (queue.Empty, queue.Full):
+            pass
+
+
+def start_queue_logging(logger, *handlers):
+    """Moves handlers behind queue. Logger gets DroppingQueueHandler,
+    handlers are called by listener thread. Listener is stopped at exit
+    after all queued records are written.
+    """
+    handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    listener = logging.handlers.QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    logger.addHandler(handler)
+    listener.start()
+
+    def stop_listener():
+        listener.stop()
+        if handler.dropped:
+            record = logger.makeRecord(logger.name, logging.WARNING, __file__, 0,
+                                       'Log queue overflow, %s records have been dropped',
+                                       (handler.dropped, ), None)
+            listener.handle(record)
+
+    atexit.register(stop_listener)
+    return handler, listener
@@ -13,7 +13,7 @@ class Port:
     def __set__(self, instance, value):
         if not 1023 < value < 65536:
             logger.critical(
-                f'Wrong port value {value}. Permissible values from 1024 to 65535.')
+                'Wrong port value %s. Permissible values from 1024 to 65535.', value)
             exit(1)
         instance.__dict__[self.name] = value
 
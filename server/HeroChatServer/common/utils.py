@@ -1,20 +1,98 @@
-"""File contains base functions to send and receive messages."""
+"""File contains base functions to send and receive messages.
+Every message is sent as a frame: 4 bytes big-endian length header and body
+encoded by connection codec (JSON by default).
+"""
 
 from common.variables import *
 from common.errors import IncorrectDataRecivedError, NonDictInputError
-import json
+from common.serializers import JSON_CODEC, AVAILABLE_CODECS
 import sys
+import errno
+import struct
+import weakref
+from collections import deque
 from common.decos import log
 sys.path.append('../')
 
+FRAME_HEADER = struct.Struct('!I')
+socket_buffers = weakref.WeakKeyDictionary()
 
-@log
-def get_message(client):
-    """Base function to get messages."""
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
+
+class MessageBuffer:
+    """Incremental frame decoder. Collects received bytes
+    and splits them to complete messages. Frame longer than 'limit' is rejected.
+    """
+    def __init__(self, codec=JSON_CODEC, limit=MAX_MESSAGE_LENGTH):
+        self.data = bytearray()
+        self.messages = deque()
+        self.codec = codec
+        self.limit = limit
+
+    def feed(self, data):
+        """Adds received bytes to buffer. Decoded messages are appended to 'messages'."""
+        self.data += data
+        offset = 0
+        while len(self.data) - offset >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self.data, offset)
+            if length > self.limit:
+                raise IncorrectDataRecivedError
+            end = offset + FRAME_HEADER.size + length
+            if len(self.data) < end:
+                break
+            self.messages.append(decode_message(bytes(self.data[offset + FRAME_HEADER.size:end]), self.codec))
+            offset = end
+        if offset:
+            del self.data[:offset]
+
+
+def encode_message(message, codec=JSON_CODEC):
+    """Encodes message dictionary to frame bytes for sending."""
+    if not isinstance(message, dict):
+        raise NonDictInputError
+    encoded_message = codec.encode(message)
+    return FRAME_HEADER.pack(len(encoded_message)) + encoded_message
+
+
+# Constant responses are encoded once by every codec and sent as bytes.
+ENCODED_200 = {codec: encode_message(RESPONSE_200, codec) for codec in AVAILABLE_CODECS.values()}
+ENCODED_205 = {codec: encode_message(RESPONSE_205, codec) for codec in AVAILABLE_CODECS.values()}
+
+
+def ok_response(request, codec=JSON_CODEC):
+    """Returns 200 response for request. Pre-encoded frame is returned
+    if request has no id, otherwise new dictionary with the same id.
+    """
+    if REQUEST_ID in request:
+        return {RESPONSE: 200, REQUEST_ID: request[REQUEST_ID]}
+    return ENCODED_200[codec]
+
+
+def response_to(request, response):
+    """Adds id of request to response dictionary, so client can match response to request."""
+    if REQUEST_ID in request:
+        response[REQUEST_ID] = request[REQUEST_ID]
+    return response
+
+
+def error_response(error):
+    """Creates new 400 response with error text."""
+    return {RESPONSE: 400, ERROR: error}
+
+
+def list_response(list_info):
+    """Creates new 202 response with list of data."""
+    return {RESPONSE: 202, LIST_INFO: list_info}
+
+
+def data_response(data):
+    """Creates new 511 response with data."""
+    return {RESPONSE: 511, DATA: data}
+
+
+def decode_message(encoded_response, codec=JSON_CODEC):
+    """Decodes received frame body to message dictionary."""
     if isinstance(encoded_response, bytes):
-        json_response = encoded_response.decode(ENCODING)
-        response = json.loads(json_response)
+        response = codec.decode(encoded_response)
         if isinstance(response, dict):
             return response
         else:
@@ -23,11 +101,32 @@ def get_message(client):
         raise IncorrectDataRecivedError
 
 
+@log
+def get_message(client):
+    """Base function to get messages. Reads socket until one full message is received,
+    the rest of data is kept in socket buffer for next calls.
+    """
+    buffer = socket_buffers.get(client)
+    if buffer is None:
+        buffer = socket_buffers[client] = MessageBuffer()
+    while not buffer.messages:
+        encoded_response = client.recv(MAX_PACKAGE_LENGTH)
+        if not encoded_response:
+            raise ConnectionResetError(errno.ECONNRESET, 'Connection closed by remote host')
+        buffer.feed(encoded_response)
+    return buffer.messages.popleft()
+
+
+def set_socket_codec(sock, codec):
+    """Sets codec for next messages sent and received through socket."""
+    buffer = socket_buffers.get(sock)
+    if buffer is None:
+        buffer = socket_buffers[sock] = MessageBuffer()
+    buffer.codec = codec
+
+
 @log
 def send_message(sock, message):
     """Base function to send messages."""
-    if not isinstance(message, dict):
-        raise NonDictInputError
-    js_message = json.dumps(message)
-    encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+    buffer = socket_buffers.get(sock)
+    sock.sendall(encode_message(message, buffer.codec if buffer else JSON_CODEC))
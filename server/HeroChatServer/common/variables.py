@@ -1,11 +1,42 @@
 import logging
+import os
 
 DEFAULT_PORT = 8000
 DEFAULT_IP_ADDRESS = '127.0.0.1'
-MAX_CONNECTIONS = 5
-MAX_PACKAGE_LENGTH = 1024
+MAX_CONNECTIONS = 1024
+MAX_PACKAGE_LENGTH = 65536
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+# Limit of frame sent to server: batch of MESSAGE_BATCH_LIMIT encrypted messages fits in it.
+MAX_REQUEST_LENGTH = 512 * 1024
+# Relay frames are JSON: binary fields grow by 4/3 in base64 and escaped characters
+# of strings up to 6 times, so any client frame forwarded to another node fits in limit.
+MAX_RELAY_LENGTH = MAX_REQUEST_LENGTH * 6 + 64 * 1024
+AUTH_TIMEOUT = 5
+MAX_OUTBOX_SIZE = 4 * 1024 * 1024
+RESPONSE_TIMEOUT = 5
+REQUEST_WINDOW = 32
+MESSAGE_BATCH_LIMIT = 1000
+COUNTERS_FLUSH_INTERVAL = 5
+COUNTERS_FLUSH_SIZE = 1000
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_SIZE = -64 * 1024
+SERVER_SCHEMA_VERSION = 3
+CLIENT_SCHEMA_VERSION = 2
+MESSAGES_COMMIT_SIZE = 500
+MESSAGES_COMMIT_INTERVAL = 1
+OFFLINE_MESSAGES_LIMIT = 100
+STAT_PAGE_SIZE = 200
+HISTORY_PAGE_SIZE = 20
+SEARCH_RESULTS_LIMIT = 50
+SEARCH_RANK_WINDOW = 5000
+OFFLINE_MESSAGE_TTL = 7 * 24 * 60 * 60
+RELAY_QUEUE_SIZE = 10000
+RELAY_RETRY_INTERVAL = 1
 ENCODING = 'utf-8'
-LOGGING_LEVEL = logging.DEBUG
+# Level can be changed without code edit, e.g. HEROCHAT_LOGGING_LEVEL=INFO.
+# Debug logging is switched off completely on levels above DEBUG.
+LOGGING_LEVEL = getattr(logging, os.environ.get('HEROCHAT_LOGGING_LEVEL', 'DEBUG').upper(), logging.DEBUG)
+LOG_QUEUE_SIZE = 10000
 SERVER_CONFIG = 'server.ini'
 
 
@@ -17,6 +48,10 @@ SENDER = 'from'
 DESTINATION = 'to'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+REQUEST_ID = 'id'
+CODECS = 'codecs'
+CODEC = 'codec'
+NODE = 'node'
 
 
 PRESENCE = 'presence'
@@ -24,6 +59,8 @@ RESPONSE = 'response'
 ERROR = 'error'
 MESSAGE = 'message'
 MESSAGE_TEXT = 'mess_text'
+MESSAGE_BATCH = 'message_batch'
+MESSAGES = 'messages'
 EXIT = 'exit'
 GET_CONTACTS = 'get_contacts'
 LIST_INFO = 'data_list'
@@ -31,16 +68,12 @@ REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
+RELAY_HELLO = 'relay_hello'
+RELAY_ONLINE = 'relay_online'
+RELAY_OFFLINE = 'relay_offline'
+USER_LOGIN = 'login'
+USER_LOGOUT = 'logout'
 
 RESPONSE_200 = {RESPONSE: 200}
 
-RESPONSE_202 = {RESPONSE: 202,
-                LIST_INFO: None}
-
 RESPONSE_205 = {RESPONSE: 205}
-
-RESPONSE_400 = {RESPONSE: 400,
-                ERROR: None}
-
-RESPONSE_511 = {RESPONSE: 511,
-                DATA: None}
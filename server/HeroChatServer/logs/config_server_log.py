@@ -4,6 +4,7 @@ import logging
 import logging.handlers
 import os
 from common.variables import LOGGING_LEVEL
+from logs.log_queue import start_queue_logging
 
 sys.path.append('../')
 server_formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(message)s')
@@ -15,8 +16,7 @@ steam.setLevel(logging.INFO)
 log_file = logging.handlers.TimedRotatingFileHandler(path, encoding='utf8', interval=1, when='D')
 log_file.setFormatter(server_formatter)
 logger = logging.getLogger('server')
-logger.addHandler(steam)
-logger.addHandler(log_file)
+queue_handler, listener = start_queue_logging(logger, steam, log_file)
 logger.setLevel(LOGGING_LEVEL)
 
 if __name__ == '__main__':
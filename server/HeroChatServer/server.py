@@ -9,7 +9,10 @@ import logs.config_server_log
 from common.utils import *
 from common.decos import log
 from server.core import MessageProcessor
-from server.database import ServerStorage
+from server.async_core import AsyncMessageProcessor
+from server.storage_worker import StorageWorker
+from server.workers import WorkerPool, reuse_port_supported
+from server.relay import relay_from_config
 from server.main_window import MainWindow
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import Qt
@@ -25,18 +28,30 @@ def arg_parser(default_port, default_address):
     parser.add_argument('-p', default=default_port, type=int, nargs='?')
     parser.add_argument('-a', default=default_address, nargs='?')
     parser.add_argument('--no_gui', action='store_true')
+    parser.add_argument('--async_engine', action='store_true')
+    parser.add_argument('--config', default=None)
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.no_gui
-    return listen_address, listen_port, gui_flag
+    async_flag = namespace.async_engine
+    return listen_address, listen_port, gui_flag, async_flag
 
 
-def config_load():
-    """Tries to load config from file."""
+def config_path_arg():
+    """Returns path of config file from --config argument or None."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--config', default=None)
+    return parser.parse_known_args(sys.argv[1:])[0].config
+
+
+def config_load(path=None):
+    """Tries to load config from file. By default server.ini near this file is used."""
     config = configparser.ConfigParser()
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    config.read(f"{dir_path}/{'server.ini'}")
+    if path is None:
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        path = f"{dir_path}/{'server.ini'}"
+    config.read(path)
     if 'SETTINGS' in config:
         return config
     else:
@@ -45,31 +60,57 @@ def config_load():
         config.set('SETTINGS', 'Listen_Address', '')
         config.set('SETTINGS', 'Database_path', '')
         config.set('SETTINGS', 'Database_file', 'server_database.db3')
+        config.set('SETTINGS', 'Workers', '1')
         return config
 
 
 def main():
     """Main function."""
-    config = config_load()
-    listen_address, listen_port, gui_flag = arg_parser(config['SETTINGS']['Default_port'],
-                                                       config['SETTINGS']['Listen_Address'])
-    database = ServerStorage(os.path.join(config['SETTINGS']['Database_path'], config['SETTINGS']['Database_file']))
-    server = MessageProcessor(listen_address, listen_port, database)
-    server.daemon = True
+    config = config_load(config_path_arg())
+    listen_address, listen_port, gui_flag, async_flag = arg_parser(config['SETTINGS']['Default_port'],
+                                                                   config['SETTINGS']['Listen_Address'])
+    database_path = os.path.join(config['SETTINGS']['Database_path'], config['SETTINGS']['Database_file'])
+    database = StorageWorker(database_path)
+    database.start()
+    workers = config['SETTINGS'].getint('Workers', 1)
+    relay = relay_from_config(config)
+    if relay and workers > 1:
+        logger.error('Cluster node can not run several workers, server is running in one process')
+        workers = 1
+    if workers > 1 and not reuse_port_supported():
+        logger.error('Several workers are not supported on this OS, server is running in one process')
+        workers = 1
+    if workers > 1:
+        server = WorkerPool(listen_address, listen_port, database_path, workers, async_flag)
+    elif async_flag:
+        server = AsyncMessageProcessor(listen_address, listen_port, database, relay=relay)
+    else:
+        server = MessageProcessor(listen_address, listen_port, database, relay=relay)
+    if workers == 1:
+        server.daemon = True
     server.start()
+    if relay:
+        relay.start(server)
     if gui_flag:
         while True:
             command = input('Введите exit для завершения работы сервера.')
             if command == 'exit':
-                server.running = False
+                if relay:
+                    relay.stop()
+                server.stop()
                 server.join()
+                database.stop()
                 break
     else:
         server_app = QApplication(sys.argv)
         server_app.setAttribute(Qt.AA_DisableWindowContextHelpButton)
         main_window = MainWindow(database, server, config)
         server_app.exec_()
-        server.running = False
+        if relay:
+            relay.stop()
+        server.stop()
+        server.join()
+        database.stop()
 
 
 if __name__ == '__main__':
@@ -76,7 +76,7 @@ class RegisterUser(QDialog):
             passwd_bytes = self.client_passwd.text().encode('utf-8')
             salt = self.client_name.text().lower().encode('utf-8')
             passwd_hash = hashlib.pbkdf2_hmac('sha512', passwd_bytes, salt, 10000)
-            self.database.add_user(self.client_name.text(), binascii.hexlify(passwd_hash))
+            self.database.add_user(self.client_name.text(), binascii.hexlify(passwd_hash)).result()
             self.messages.information(self, 'Done', 'User has been successfully registered')
             self.server.service_update_lists()
             self.close()
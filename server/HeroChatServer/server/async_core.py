@@ -0,0 +1,422 @@
+"""This file contains an asyncio based server logic. Alternative to MessageProcessor.
+Every connection is served by its own coroutine and writes its outgoing data
+in its own task, so slow client doesn't block others.
+"""
+
+import threading
+import asyncio
+import logging
+import socket
+import hmac
+import hashlib
+import binascii
+import os
+import datetime
+from common.metaclasses import ServerMaker
+from common.descryptors import Port
+from common.variables import *
+from common.errors import IncorrectDataRecivedError
+from common.utils import encode_message, decode_message, FRAME_HEADER, ENCODED_200, ENCODED_205, \
+    error_response, list_response, data_response, ok_response, response_to
+from common.serializers import JSON_CODEC, choose_codec, binary, text
+from server.dispatch import message_action, batch_messages
+
+logger = logging.getLogger('server')
+
+
+class ClientOutbox:
+    """Outgoing data of connection. Data is queued without waiting and written
+    by writer task of connection. 'size' is amount of data not written yet.
+    Queue also holds callbacks called when data queued before them is written.
+    """
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.size = 0
+
+
+class AsyncMessageProcessor(threading.Thread, metaclass=ServerMaker):
+
+    port = Port()
+    def __init__(self, listen_address, listen_port, database, relay=None, reuse_port=False):
+        self.addr = listen_address
+        self.port = listen_port
+        self.database = database
+        self.relay = relay
+        self.observers = []
+        self.reuse_port = reuse_port
+        self.loop = None
+        self.stopped = None
+
+        self.clients = dict()
+        self.sessions = dict()
+        self.codecs = dict()
+        self.outboxes = dict()
+        self.running = True
+
+        self.names = dict()
+        self.handlers = {
+            PRESENCE: self.autorize_user,
+            MESSAGE: self.handle_message,
+            MESSAGE_BATCH: self.handle_message_batch,
+            EXIT: self.handle_exit,
+            GET_CONTACTS: self.handle_get_contacts,
+            ADD_CONTACT: self.handle_add_contact,
+            REMOVE_CONTACT: self.handle_remove_contact,
+            USERS_REQUEST: self.handle_users_request,
+            PUBLIC_KEY_REQUEST: self.handle_public_key_request,
+        }
+        super().__init__()
+
+    def run(self):
+        """Basic function to run server. Runs event loop until server is stopped."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        """Creates socket object and serves connections until stop."""
+        logger.info(
+            'Server is running %s, connection address: %s.\nIf address is empty all connection applied', self.port, self.addr)
+        transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        transport.bind((self.addr, self.port))
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_server(self.handle_client, sock=transport, backlog=MAX_CONNECTIONS)
+        async with server:
+            if self.running:
+                await self.stopped.wait()
+        for client in list(self.clients):
+            self.remove_client(client)
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        """Stops server loop. Safe to call from another thread."""
+        self.running = False
+        if self.loop and self.stopped:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def handle_client(self, reader, writer):
+        """Connection coroutine. Authorizes client and processes his messages."""
+        client_address = writer.get_extra_info('peername')
+        logger.info('Applied connection from %s', client_address)
+        self.clients[writer] = client_address
+        self.codecs[writer] = JSON_CODEC
+        self.outboxes[writer] = ClientOutbox()
+        asyncio.create_task(self.write_client(writer, self.outboxes[writer]))
+        try:
+            while self.running and writer in self.clients:
+                message = await self.read_message(reader, self.codecs[writer])
+                await self.process_client_message(message, reader, writer)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError,
+                asyncio.CancelledError, ValueError, TypeError, KeyError, IncorrectDataRecivedError):
+            pass
+        finally:
+            self.remove_client(writer)
+
+    async def read_message(self, reader, codec):
+        """Reads one message frame from connection and decodes it with connection codec."""
+        length, = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        if length > MAX_REQUEST_LENGTH:
+            raise IncorrectDataRecivedError
+        return decode_message(await reader.readexactly(length), codec)
+
+    def send(self, writer, message, on_written=None):
+        """Queues message (dictionary or pre-encoded bytes) for connection without
+        waiting. Client which has more than MAX_OUTBOX_SIZE of unsent data is disconnected.
+        'on_written' is called when message has been written.
+        """
+        outbox = self.outboxes.get(writer)
+        if outbox is None:
+            return
+        if outbox.size > MAX_OUTBOX_SIZE:
+            logger.error('Client %s does not read messages. Connection closed.', self.clients[writer])
+            self.remove_client(writer)
+            writer.transport.abort()
+            return
+        data = message if isinstance(message, bytes) else encode_message(message, self.codecs[writer])
+        outbox.size += len(data)
+        outbox.queue.put_nowait(data)
+        if on_written:
+            outbox.queue.put_nowait(on_written)
+
+    async def write_client(self, writer, outbox):
+        """Writer task of connection. Writes queued data until connection
+        is removed, then closes it.
+        """
+        try:
+            while True:
+                items = [await outbox.queue.get()]
+                while not outbox.queue.empty():
+                    items.append(outbox.queue.get_nowait())
+                data = b''.join(item for item in items if isinstance(item, bytes))
+                writer.write(data)
+                if items[-1] is None:
+                    break
+                await writer.drain()
+                outbox.size -= len(data)
+                for item in items:
+                    if callable(item):
+                        item()
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            self.remove_client(writer)
+            writer.close()
+
+    def remove_client(self, client):
+        """Delete client from server. Safe to call from another thread."""
+        if threading.current_thread() is not self:
+            self.loop.call_soon_threadsafe(self.remove_client, client)
+            return
+        if client not in self.clients:
+            return
+        logger.info('Client %s has been disconnected from server', self.clients.pop(client))
+        self.codecs.pop(client, None)
+        # Writer task closes connection after queued data is written.
+        self.outboxes.pop(client).queue.put_nowait(None)
+        name = self.sessions.pop(client, None)
+        if name and self.names.get(name) is client:
+            logout = self.database.user_logout(name)
+            del self.names[name]
+            self.notify(USER_LOGOUT, name)
+            if self.relay:
+                logout.add_done_callback(lambda done: self.relay.user_offline(name))
+
+    def process_message(self, message):
+        """Sending message function. Receive message fom user
+        and tries to send it to another user. Message for user
+        of another server node is forwarded by relay. Request id
+        of sender is removed, it is meaningless for recipient.
+        """
+        if REQUEST_ID in message:
+            message = {key: value for key, value in message.items() if key != REQUEST_ID}
+        if message[DESTINATION] not in self.names:
+            if self.relay and self.relay.locate(message[DESTINATION]):
+                self.relay.forward(message)
+            return
+        self.send(self.names[message[DESTINATION]], message)
+        logger.info('Message has been send to %s from user %s.', message[DESTINATION], message[SENDER])
+
+    async def process_client_message(self, message, reader, writer):
+        """Client's message parser. Checks message against schema
+        of its action and awaits handler from dispatch table.
+        """
+        logger.debug('Check user message : %s', message)
+        name = self.sessions.get(writer)
+        action = message_action(message, name)
+        if action != PRESENCE and not name:
+            raise TypeError
+        handler = self.handlers.get(action)
+        if handler:
+            await handler(message, reader, writer)
+        else:
+            self.send(writer, response_to(message, error_response('Incorrect request')))
+
+    async def handle_message(self, message, reader, writer):
+        """Sends message to recipient or stores it if recipient is offline.
+        Message for offline user is confirmed after it is saved.
+        """
+        if not isinstance(message[MESSAGE_TEXT], (str, bytes)):
+            self.send(writer, response_to(message, error_response('Incorrect request')))
+        elif message[DESTINATION] in self.names or self.relay and self.relay.locate(message[DESTINATION]):
+            self.database.process_message(message[SENDER], message[DESTINATION])
+            self.process_message(message)
+            self.send(writer, ok_response(message, self.codecs[writer]))
+        elif self.database.check_user(message[DESTINATION]):
+            self.database.process_message(message[SENDER], message[DESTINATION])
+            try:
+                await asyncio.wrap_future(self.database.store_offline_message(
+                    message[SENDER], message[DESTINATION], text(message[MESSAGE_TEXT])))
+            except Exception:
+                self.send(writer, response_to(message, error_response('Database error')))
+                return
+            logger.info('User %s is offline, message from %s has been stored.', message[DESTINATION], message[SENDER])
+            self.send(writer, ok_response(message, self.codecs[writer]))
+        else:
+            self.send(writer, response_to(message, error_response('User is not registered')))
+
+    async def handle_message_batch(self, message, reader, writer):
+        """Sends batch of messages in one pass. Counters and offline messages
+        are saved in one transaction each, messages for one local recipient
+        are written together. Response contains status of every entry, it is sent
+        when offline messages are saved.
+        """
+        messages = batch_messages(message)
+        if messages is None:
+            self.send(writer, response_to(message, error_response('Incorrect request')))
+            return
+        statuses = []
+        delivered = []
+        local = dict()
+        offline = []
+        offline_indexes = []
+        for item in messages:
+            if item is None:
+                statuses.append(400)
+                continue
+            if item[DESTINATION] in self.names:
+                local.setdefault(self.names[item[DESTINATION]], []).append(item)
+            elif self.relay and self.relay.locate(item[DESTINATION]):
+                self.relay.forward(item)
+            elif self.database.check_user(item[DESTINATION]):
+                offline.append((item[DESTINATION], text(item[MESSAGE_TEXT])))
+                offline_indexes.append(len(statuses))
+            else:
+                statuses.append(400)
+                continue
+            delivered.append(item[DESTINATION])
+            statuses.append(200)
+        if delivered:
+            self.database.process_messages(message[SENDER], delivered)
+        for recipient, items in local.items():
+            if recipient in self.codecs:
+                codec = self.codecs[recipient]
+                self.send(recipient, b''.join(encode_message(item, codec) for item in items))
+        if offline:
+            try:
+                await asyncio.wrap_future(self.database.store_offline_messages(message[SENDER], offline))
+            except Exception:
+                for index in offline_indexes:
+                    statuses[index] = 400
+        logger.info('Batch of %s messages from user %s has been processed.', len(delivered), message[SENDER])
+        self.send(writer, response_to(message, list_response(statuses)))
+
+    async def handle_exit(self, message, reader, writer):
+        """Disconnects client on exit message."""
+        self.remove_client(writer)
+
+    async def handle_get_contacts(self, message, reader, writer):
+        """Sends contact list of user."""
+        contacts = await asyncio.wrap_future(self.database.get_contacts(message[USER]))
+        self.send(writer, response_to(message, list_response(contacts)))
+
+    async def handle_add_contact(self, message, reader, writer):
+        """Adds contact to user contact list."""
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        self.send(writer, ok_response(message, self.codecs[writer]))
+
+    async def handle_remove_contact(self, message, reader, writer):
+        """Removes contact from user contact list."""
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        self.send(writer, ok_response(message, self.codecs[writer]))
+
+    async def handle_users_request(self, message, reader, writer):
+        """Sends list of known users."""
+        users = await asyncio.wrap_future(self.database.users_list())
+        self.send(writer, response_to(message, list_response([user[0] for user in users])))
+
+    async def handle_public_key_request(self, message, reader, writer):
+        """Sends public key of requested user. Key from relay is used
+        only for user which has no key in local database.
+        """
+        pubkey = self.database.get_pubkey(message[ACCOUNT_NAME])
+        if not pubkey and self.relay:
+            pubkey = self.relay.get_pubkey(message[ACCOUNT_NAME])
+        if pubkey:
+            self.send(writer, response_to(message, data_response(pubkey)))
+        else:
+            self.send(writer, response_to(message, error_response('No public key for this user')))
+
+    async def autorize_user(self, message, reader, writer):
+        """Authorize coroutine. Sends challenge to client and waits for answer
+        without blocking other connections. Codec chosen from client list
+        is added to challenge and used for connection after it.
+        """
+        name = message[USER][ACCOUNT_NAME]
+        if name in self.names or writer in self.sessions or self.relay and self.relay.locate(name):
+            self.send(writer, error_response('Username is already exists'))
+            self.remove_client(writer)
+        elif not self.database.check_user(name):
+            self.send(writer, error_response('User is not registered'))
+            self.remove_client(writer)
+        else:
+            random_str = binascii.hexlify(os.urandom(64))
+            digest = hmac.new(self.database.get_hash(name), random_str, hashlib.md5).digest()
+            message_auth = data_response(random_str.decode('ascii'))
+            codec = choose_codec(message.get(CODECS))
+            if CODECS in message:
+                message_auth[CODEC] = codec.name
+            self.send(writer, message_auth)
+            self.codecs[writer] = codec
+            ans = await asyncio.wait_for(self.read_message(reader, codec), AUTH_TIMEOUT)
+            if RESPONSE in ans and ans[RESPONSE] == 511 and DATA in ans \
+                    and hmac.compare_digest(digest, binary(ans[DATA])) and name not in self.names:
+                self.names[name] = writer
+                self.sessions[writer] = name
+                client_ip, client_port = self.clients[writer][:2]
+                login = self.database.user_login(name, client_ip, client_port, message[USER][PUBLIC_KEY])
+                self.notify(USER_LOGIN, name, client_ip, client_port, datetime.datetime.now())
+                if self.relay:
+                    # Peers read the key from database, so login is announced after it is saved.
+                    pubkey = message[USER][PUBLIC_KEY]
+                    login.add_done_callback(lambda done: self.relay.user_online(name, pubkey))
+                self.send(writer, ENCODED_200[self.codecs[writer]])
+                await self.send_offline_messages(writer, name)
+            else:
+                self.send(writer, error_response('Incorrect password'))
+                self.remove_client(writer)
+
+    async def send_offline_messages(self, writer, name):
+        """Sends messages stored while user was offline in one batch.
+        Messages are deleted from storage when they have been written.
+        """
+        stored = await asyncio.wrap_future(self.database.get_offline_messages(name))
+        if not stored or writer not in self.codecs:
+            return
+        logger.info('Sending %s stored messages to %s', len(stored), name)
+        codec = self.codecs[writer]
+        last_id = stored[-1][0]
+        self.send(writer, b''.join(encode_message({ACTION: MESSAGE, SENDER: sender, DESTINATION: name,
+                                                   TIME: date.timestamp(), MESSAGE_TEXT: message_text}, codec)
+                                   for message_id, sender, message_text, date in stored),
+                  lambda: self.database.remove_offline_messages(name, last_id))
+
+    def add_observer(self, callback):
+        """Subscribes callback to user login and logout events. Callback is called
+        in server thread as callback(USER_LOGIN, name, ip, port, time) or callback(USER_LOGOUT, name).
+        """
+        self.observers.append(callback)
+
+    def notify(self, event, *args):
+        """Passes event to all observers."""
+        for callback in self.observers:
+            try:
+                callback(event, *args)
+            except Exception as err:
+                logger.error('Observer error: %s', err)
+
+    def deliver(self, message):
+        """Delivers message forwarded by another server node. If recipient
+        has gone, message is stored. Safe to call from another thread.
+        """
+        if threading.current_thread() is not self:
+            self.loop.call_soon_threadsafe(self.deliver, message)
+            return
+        if message[DESTINATION] in self.names:
+            self.process_message(message)
+        elif self.database.check_user(message[DESTINATION]):
+            self.database.store_offline_message(message[SENDER], message[DESTINATION], text(message[MESSAGE_TEXT]))
+
+    def disconnect_user(self, name):
+        """Disconnects user by name. Safe to call from another thread."""
+        if threading.current_thread() is not self:
+            self.loop.call_soon_threadsafe(self.disconnect_user, name)
+            return
+        if name in self.names:
+            self.remove_client(self.names[name])
+
+    def service_update_lists(self):
+        """Updating clients list function. Safe to call from another thread."""
+        if threading.current_thread() is not self:
+            self.loop.call_soon_threadsafe(self.service_update_lists)
+            return
+        for client in list(self.names.values()):
+            self.send(client, ENCODED_205[self.codecs[client]])
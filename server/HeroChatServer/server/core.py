@@ -3,252 +3,595 @@
 import threading
 import logging
 import sys
-import select
+import selectors
 import socket
-import json
 import hmac
 import hashlib
 import binascii
+import errno
+import time
 import os
+import datetime
+from collections import deque
 from common.metaclasses import ServerMaker
 from common.descryptors import Port
 from common.variables import *
-from common.utils import send_message, get_message
+from common.errors import IncorrectDataRecivedError
+from common.utils import encode_message, MessageBuffer, ENCODED_200, ENCODED_205, \
+    error_response, list_response, data_response, ok_response, response_to
+from common.serializers import JSON_CODEC, choose_codec, binary, text
 from common.decos import login_required
+from server.dispatch import message_action, batch_messages
 
 logger = logging.getLogger('server')
 
 
+class ClientSession:
+    """Client session: address, name after authorization,
+    buffer for incoming frames and unsent outgoing data.
+    'replies' keeps responses which wait for response to earlier
+    database request, so client gets responses in order of requests.
+    'written' keeps callbacks called when 'sent' reaches their position in outgoing data.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.name = None
+        self.codec = JSON_CODEC
+        self.buffer = MessageBuffer(limit=MAX_REQUEST_LENGTH)
+        self.outbox = bytearray()
+        self.sent = 0
+        self.written = deque()
+        self.events = selectors.EVENT_READ
+        self.replies = deque()
+
+
 class MessageProcessor(threading.Thread, metaclass=ServerMaker):
 
     port = Port()
-    def __init__(self, listen_address, listen_port, database):
+    def __init__(self, listen_address, listen_port, database, relay=None, reuse_port=False):
         self.addr = listen_address
         self.port = listen_port
         self.database = database
+        self.relay = relay
+        self.observers = []
+        self.reuse_port = reuse_port
         self.sock = None
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.callbacks = deque()
 
-        self.clients = []
-        self.listen_sockets = None
-        self.error_sockets = None
+        self.clients = dict()
+        self.pending_auth = dict()
         self.running = True
 
         self.names = dict()
+        self.handlers = {
+            PRESENCE: self.autorize_user,
+            MESSAGE: self.handle_message,
+            MESSAGE_BATCH: self.handle_message_batch,
+            EXIT: self.handle_exit,
+            GET_CONTACTS: self.handle_get_contacts,
+            ADD_CONTACT: self.handle_add_contact,
+            REMOVE_CONTACT: self.handle_remove_contact,
+            USERS_REQUEST: self.handle_users_request,
+            PUBLIC_KEY_REQUEST: self.handle_public_key_request,
+        }
         super().__init__()
 
     def run(self):
-        """Basic function to run server."""
+        """Basic function to run server. Sleeps in selector until
+        listening socket or one of clients becomes readable
+        or the nearest authorization deadline expires.
+        """
         self.init_socket()
         while self.running:
+            timeout = None
+            if self.pending_auth:
+                timeout = max(next(iter(self.pending_auth.values()))[3] - time.monotonic(), 0)
             try:
-                client, client_address = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                logger.info(f'Applied connection from {client_address}')
-                client.settimeout(5)
-                self.clients.append(client)
-            recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
+                events = self.selector.select(timeout)
+                self.expire_auth()
+            except OSError as err:
+                logger.error('Socket Error: %s', err.errno)
+                continue
+            for key, mask in events:
+                if key.fileobj is self.sock:
+                    self.accept_clients()
+                elif key.fileobj is self.wakeup_reader:
+                    self.wakeup_reader.recv(MAX_PACKAGE_LENGTH)
+                else:
+                    if mask & selectors.EVENT_WRITE and key.fileobj in self.clients:
+                        try:
+                            self.flush_client(key.fileobj)
+                        except OSError:
+                            self.remove_client(key.fileobj)
+                    if mask & selectors.EVENT_READ and key.fileobj in self.clients:
+                        self.read_client(key.fileobj)
+            self.run_callbacks()
+        for client in list(self.clients):
+            self.remove_client(client)
+        self.selector.close()
+        self.sock.close()
+
+    def stop(self):
+        """Stops server loop. Safe to call from another thread."""
+        self.running = False
+        self.wakeup()
+
+    def wakeup(self):
+        """Interrupts waiting in selector."""
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def call_soon(self, callback, *args):
+        """Schedules callback to be called in server thread. Safe to call from another thread."""
+        self.callbacks.append((callback, args))
+        self.wakeup()
+
+    def run_callbacks(self):
+        """Calls all scheduled callbacks. Error of one callback is logged,
+        so it doesn't stop server thread.
+        """
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
             try:
-                if self.clients:
-                    recv_data_lst, self.listen_sockets, self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0)
+                callback(*args)
+            except Exception as err:
+                logger.error('Callback error in %s: %s', getattr(callback, '__name__', callback), err)
+
+    def reply_when_done(self, client, request, future, make_response, make_error=None):
+        """Sends response built from database result when database request is done.
+        Responses to next requests of client wait for it. If request has failed,
+        response is built by 'make_error' or database error is sent.
+        """
+        slot = [None]
+        self.clients[client].replies.append(slot)
+        future.add_done_callback(lambda done: self.call_soon(
+            self.send_reply, client, request, slot, done, make_response, make_error))
+
+    def send_reply(self, client, request, slot, future, make_response, make_error=None):
+        """Builds response from finished database request. Sends it with
+        following responses which are ready.
+        """
+        session = self.clients.get(client)
+        if session is None:
+            return
+        if future.exception():
+            slot[0] = response_to(request, make_error() if make_error else error_response('Database error'))
+        else:
+            slot[0] = response_to(request, make_response(future.result()))
+        ready = []
+        while session.replies and session.replies[0][0] is not None:
+            ready.append(session.replies.popleft()[0])
+        try:
+            self.send_data(client, b''.join(response if isinstance(response, bytes)
+                                            else encode_message(response, session.codec) for response in ready))
+        except OSError:
+            self.remove_client(client)
+
+    def accept_clients(self):
+        """Accepts all pending connections and registers them in selector."""
+        while True:
+            try:
+                client, client_address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
             except OSError as err:
-                logger.error(f'Socket Error: {err.errno}')
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
-                    try:
-                        self.process_client_message(get_message(client_with_message), client_with_message)
-                    except (OSError, json.JSONDecodeError, TypeError):
-                        self.remove_client(client_with_message)
+                logger.error('Accept Error: %s', err.errno)
+                return
+            logger.info('Applied connection from %s', client_address)
+            client.setblocking(False)
+            self.clients[client] = ClientSession(client_address)
+            self.selector.register(client, selectors.EVENT_READ)
+
+    def read_client(self, client):
+        """Reads available data from client and processes every complete message."""
+        session = self.clients[client]
+        try:
+            data = client.recv(MAX_PACKAGE_LENGTH)
+            if not data:
+                raise ConnectionResetError(errno.ECONNRESET, 'Connection closed by remote host')
+            session.buffer.feed(data)
+            while session.buffer.messages and client in self.clients:
+                if client in self.pending_auth:
+                    self.check_auth_answer(session.buffer.messages.popleft(), client)
+                else:
+                    self.process_client_message(session.buffer.messages.popleft(), client)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except (OSError, ValueError, TypeError, KeyError, IncorrectDataRecivedError):
+            self.remove_client(client)
+
+    def send_to(self, client, message):
+        """Queues message (dictionary or pre-encoded bytes) for client and tries
+        to send it at once. Unsent rest is written when socket becomes writable.
+        """
+        if not isinstance(message, bytes):
+            message = encode_message(message, self.client_codec(client))
+        self.send_data(client, message)
+
+    def send_batch(self, client, messages, on_written=None):
+        """Queues several messages for client and sends them together.
+        'on_written' is called when all of them have been written to socket.
+        """
+        codec = self.client_codec(client)
+        self.send_data(client, b''.join(encode_message(message, codec) for message in messages), on_written)
+
+    def client_codec(self, client):
+        """Returns codec of client connection."""
+        session = self.clients.get(client)
+        return session.codec if session else JSON_CODEC
+
+    def send_data(self, client, data, on_written=None):
+        """Appends encoded data to client outbox and tries to write it.
+        Client which has more than MAX_OUTBOX_SIZE of unsent data is disconnected.
+        """
+        if client not in self.clients:
+            raise ConnectionResetError(errno.ECONNRESET, 'Client has been disconnected')
+        session = self.clients[client]
+        if len(session.outbox) > MAX_OUTBOX_SIZE:
+            logger.error('Client %s does not read messages. Connection closed.', session.address)
+            self.remove_client(client)
+            raise ConnectionResetError(errno.ECONNRESET, 'Client does not read messages')
+        pending = bool(session.outbox)
+        session.outbox += data
+        if on_written:
+            session.written.append((session.sent + len(session.outbox), on_written))
+        if not pending:
+            self.flush_client(client)
+
+    def flush_client(self, client):
+        """Writes as much unsent data as socket accepts."""
+        session = self.clients[client]
+        try:
+            sent = client.send(session.outbox)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        del session.outbox[:sent]
+        session.sent += sent
+        while session.written and session.written[0][0] <= session.sent:
+            session.written.popleft()[1]()
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if session.outbox else selectors.EVENT_READ
+        if session.events != events:
+            session.events = events
+            self.selector.modify(client, events)
 
     def remove_client(self, client):
-        """Delete client from server."""
-        logger.info(f'Client {client.getpeername()} has been disconnected from server')
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
+        """Delete client from server. Safe to call from another thread."""
+        if threading.current_thread() is not self:
+            self.call_soon(self.remove_client, client)
+            return
+        if client not in self.clients:
+            return
+        session = self.clients.pop(client)
+        logger.info('Client %s has been disconnected from server', session.address)
+        self.pending_auth.pop(client, None)
+        if session.name and self.names.get(session.name) is client:
+            logout = self.database.user_logout(session.name)
+            del self.names[session.name]
+            self.notify(USER_LOGOUT, session.name)
+            if self.relay:
+                name = session.name
+                logout.add_done_callback(lambda done: self.relay.user_offline(name))
+        self.selector.unregister(client)
         client.close()
 
     def init_socket(self):
         """Create socket object."""
         logger.info(
-            f'Server is running {self.port}, connection address: {self.addr}.\nIf address is empty all connection applied')
+            'Server is running %s, connection address: %s.\nIf address is empty all connection applied', self.port, self.addr)
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         transport.bind((self.addr, self.port))
-        transport.settimeout(0.5)
+        transport.setblocking(False)
         self.sock = transport
         self.sock.listen(MAX_CONNECTIONS)
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
 
     def process_message(self, message):
 
         """Sending message function. Receive message fom user
-        and tries to send it to another user.
+        and tries to send it to another user. Message for user
+        of another server node is forwarded by relay. Request id
+        of sender is removed, it is meaningless for recipient.
         """
+        if REQUEST_ID in message:
+            message = {key: value for key, value in message.items() if key != REQUEST_ID}
 
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]] in self.listen_sockets:
+        if message[DESTINATION] in self.names:
+            recipient = self.names[message[DESTINATION]]
             try:
-                send_message(self.names[message[DESTINATION]], message)
+                self.send_to(recipient, message)
                 logger.info(
-                    f'Message has been send to {message[DESTINATION]} from user {message[SENDER]}.')
+                    'Message has been send to %s from user %s.', message[DESTINATION], message[SENDER])
             except OSError:
-                self.remove_client(message[DESTINATION])
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in self.listen_sockets:
-            logger.error(
-                f'Connection with client {message[DESTINATION]} has been lost. Connection closed.')
-            self.remove_client(self.names[message[DESTINATION]])
+                logger.error(
+                    'Connection with client %s has been lost. Connection closed.', message[DESTINATION])
+                self.remove_client(recipient)
+        elif self.relay and self.relay.locate(message[DESTINATION]):
+            self.relay.forward(message)
+            logger.info('Message to %s from user %s has been forwarded to node %s.',
+                        message[DESTINATION], message[SENDER], self.relay.locate(message[DESTINATION]))
         else:
             logger.error(
-                f"User {message[DESTINATION]} is not online or not registered, failed to send message")
+                'User %s is not online or not registered, failed to send message', message[DESTINATION])
 
     @login_required
     def process_client_message(self, message, client):
 
-        """Client's message parser. Tries to receive message from client,
-        parse it and creating an answer.
-        """
-
-        logger.debug(f'Check user message : {message}')
-        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            self.autorize_user(message, client)
-        elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
-                and SENDER in message and MESSAGE_TEXT in message and self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
-                self.database.process_message(message[SENDER], message[DESTINATION])
-                self.process_message(message)
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = "'User is not online or not registered"
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
+        """Client's message parser. Checks message against schema
+        of its action and calls handler from dispatch table.
+        """
+
+        logger.debug('Check user message : %s', message)
+        handler = self.handlers.get(message_action(message, self.clients[client].name))
+        if handler:
+            handler(message, client)
+        else:
+            self.reply(client, message, error_response('Incorrect request'))
+
+    def reply(self, client, request, response):
+        """Sends response to request or puts it after response to earlier
+        database request. Disconnects client if sending failed.
+        """
+        session = self.clients.get(client)
+        if session and session.replies:
+            session.replies.append([response_to(request, response)])
             return
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
+        try:
+            self.send_to(client, response_to(request, response))
+        except OSError:
             self.remove_client(client)
-        elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
-                self.names[message[USER]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
-        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0] for user in self.database.users_list()]
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
-        elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
-            response = RESPONSE_511
-            response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'No public key for this user'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
+
+    def handle_message(self, message, client):
+        """Sends message to recipient or stores it if recipient is offline.
+        Message for offline user is confirmed after it is saved.
+        """
+        if not isinstance(message[MESSAGE_TEXT], (str, bytes)):
+            self.reply(client, message, error_response('Incorrect request'))
+        elif message[DESTINATION] in self.names or self.relay and self.relay.locate(message[DESTINATION]):
+            self.database.process_message(message[SENDER], message[DESTINATION])
+            self.process_message(message)
+            self.reply(client, message, ok_response(message, self.client_codec(client)))
+        elif self.database.check_user(message[DESTINATION]):
+            self.database.process_message(message[SENDER], message[DESTINATION])
+            codec = self.client_codec(client)
+            self.reply_when_done(client, message, self.database.store_offline_message(
+                message[SENDER], message[DESTINATION], text(message[MESSAGE_TEXT])),
+                lambda result: ok_response(message, codec))
+            logger.info('User %s is offline, message from %s has been stored.', message[DESTINATION], message[SENDER])
         else:
-            response = RESPONSE_400
-            response[ERROR] = 'Incorrect request'
+            self.reply(client, message, error_response('User is not registered'))
+
+    def handle_message_batch(self, message, client):
+        """Sends batch of messages in one pass. Counters and offline messages
+        are saved in one transaction each, messages for one local recipient
+        are sent together. Response contains status of every entry, it is sent
+        when offline messages are saved.
+        """
+        messages = batch_messages(message)
+        if messages is None:
+            self.reply(client, message, error_response('Incorrect request'))
+            return
+        statuses = []
+        delivered = []
+        local = dict()
+        offline = []
+        offline_indexes = []
+        for item in messages:
+            if item is None:
+                statuses.append(400)
+                continue
+            if item[DESTINATION] in self.names:
+                local.setdefault(item[DESTINATION], []).append(item)
+            elif self.relay and self.relay.locate(item[DESTINATION]):
+                self.relay.forward(item)
+            elif self.database.check_user(item[DESTINATION]):
+                offline.append((item[DESTINATION], text(item[MESSAGE_TEXT])))
+                offline_indexes.append(len(statuses))
+            else:
+                statuses.append(400)
+                continue
+            delivered.append(item[DESTINATION])
+            statuses.append(200)
+        for name, items in local.items():
+            recipient = self.names[name]
             try:
-                send_message(client, response)
+                self.send_batch(recipient, items)
             except OSError:
-                self.remove_client(client)
+                logger.error('Connection with client %s has been lost. Connection closed.', name)
+                self.remove_client(recipient)
+        if delivered:
+            self.database.process_messages(message[SENDER], delivered)
+        logger.info('Batch of %s messages from user %s has been processed.', len(delivered), message[SENDER])
+        if offline:
+            failed = list(statuses)
+            for index in offline_indexes:
+                failed[index] = 400
+            self.reply_when_done(client, message, self.database.store_offline_messages(message[SENDER], offline),
+                                 lambda result: list_response(statuses), lambda: list_response(failed))
+        else:
+            self.reply(client, message, list_response(statuses))
+
+    def handle_exit(self, message, client):
+        """Disconnects client on exit message."""
+        self.remove_client(client)
+
+    def handle_get_contacts(self, message, client):
+        """Sends contact list of user."""
+        self.reply_when_done(client, message, self.database.get_contacts(message[USER]), list_response)
+
+    def handle_add_contact(self, message, client):
+        """Adds contact to user contact list."""
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        self.reply(client, message, ok_response(message, self.client_codec(client)))
+
+    def handle_remove_contact(self, message, client):
+        """Removes contact from user contact list."""
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        self.reply(client, message, ok_response(message, self.client_codec(client)))
+
+    def handle_users_request(self, message, client):
+        """Sends list of known users."""
+        self.reply_when_done(client, message, self.database.users_list(),
+                             lambda users: list_response([user[0] for user in users]))
+
+    def handle_public_key_request(self, message, client):
+        """Sends public key of requested user. Key from relay is used
+        only for user which has no key in local database.
+        """
+        pubkey = self.database.get_pubkey(message[ACCOUNT_NAME])
+        if not pubkey and self.relay:
+            pubkey = self.relay.get_pubkey(message[ACCOUNT_NAME])
+        if pubkey:
+            self.reply(client, message, data_response(pubkey))
+        else:
+            self.reply(client, message, error_response('No public key for this user'))
 
     def autorize_user(self, message, sock):
 
-        """Authorize function. Receive a values from client.
-        Send a result of authorizing.
+        """Authorize function. Checks user and sends him a challenge.
+        If client sent list of codecs, chosen codec is added to challenge
+        and used for connection after it. Answer is checked by 'check_auth_answer' when it comes.
         """
 
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
-            response = RESPONSE_400
-            response[ERROR] = 'Username is already exists'
+        if message[USER][ACCOUNT_NAME] in self.names.keys() or sock in self.pending_auth or self.clients[sock].name \
+                or self.relay and self.relay.locate(message[USER][ACCOUNT_NAME]):
             try:
-                send_message(sock, response)
+                self.send_to(sock, error_response('Username is already exists'))
             except OSError:
                 pass
-            self.clients.remove(sock)
-            sock.close()
+            self.remove_client(sock)
         elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
-            response = RESPONSE_400
-            response[ERROR] = "User is not registered"
             try:
-                send_message(sock, response)
+                self.send_to(sock, error_response('User is not registered'))
             except OSError:
                 pass
-            self.clients.remove(sock)
-            sock.close()
+            self.remove_client(sock)
         else:
-            message_auth = RESPONSE_511
             random_str = binascii.hexlify(os.urandom(64))
-            message_auth[DATA] = random_str.decode('ascii')
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str)
+            message_auth = data_response(random_str.decode('ascii'))
+            codec = choose_codec(message.get(CODECS))
+            if CODECS in message:
+                message_auth[CODEC] = codec.name
+            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, hashlib.md5)
             digest = hash.digest()
             try:
-                send_message(sock, message_auth)
-                ans = get_message(sock)
+                self.send_to(sock, message_auth)
             except OSError:
-                sock.close()
+                self.remove_client(sock)
                 return
-            client_digest = binascii.a2b_base64(ans[DATA])
-            if RESPONSE in ans and ans[RESPONSE] == 511 and hmac.compare_digest(digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-                try:
-                    send_message(sock, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                self.database.user_login(message[USER][ACCOUNT_NAME],
-                                         client_ip, client_port, message[USER][PUBLIC_KEY])
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Incorrect password'
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
+            self.clients[sock].codec = self.clients[sock].buffer.codec = codec
+            self.pending_auth[sock] = (message[USER][ACCOUNT_NAME], digest, message[USER][PUBLIC_KEY],
+                                       time.monotonic() + AUTH_TIMEOUT)
+
+    def check_auth_answer(self, ans, sock):
+        """Checks client answer for authorization challenge."""
+        name, digest, pubkey, deadline = self.pending_auth.pop(sock)
+        client_digest = binary(ans[DATA]) if DATA in ans else b''
+        if RESPONSE in ans and ans[RESPONSE] == 511 and hmac.compare_digest(digest, client_digest) \
+                and name not in self.names:
+            self.names[name] = sock
+            self.clients[sock].name = name
+            client_ip, client_port = self.clients[sock].address[:2]
+            login = self.database.user_login(name, client_ip, client_port, pubkey)
+            self.notify(USER_LOGIN, name, client_ip, client_port, datetime.datetime.now())
+            if self.relay:
+                # Peers read the key from database, so login is announced after it is saved.
+                login.add_done_callback(lambda done: self.relay.user_online(name, pubkey))
+            try:
+                self.send_to(sock, ENCODED_200[self.client_codec(sock)])
+            except OSError:
+                self.remove_client(sock)
+                return
+            future = self.database.get_offline_messages(name)
+            future.add_done_callback(lambda done: self.call_soon(self.send_offline_messages, sock, name, done))
+        else:
+            try:
+                self.send_to(sock, error_response('Incorrect password'))
+            except OSError:
+                pass
+            self.remove_client(sock)
+
+    def send_offline_messages(self, client, name, future):
+        """Sends messages stored while user was offline in one batch.
+        Messages are deleted from storage when they have been written to socket,
+        so they are kept if user has gone before.
+        """
+        if future.exception() or not future.result() or client not in self.clients:
+            return
+        stored = future.result()
+        messages = [{ACTION: MESSAGE, SENDER: sender, DESTINATION: name, TIME: date.timestamp(),
+                     MESSAGE_TEXT: message_text} for message_id, sender, message_text, date in stored]
+        last_id = stored[-1][0]
+        logger.info('Sending %s stored messages to %s', len(messages), name)
+        try:
+            self.send_batch(client, messages, lambda: self.database.remove_offline_messages(name, last_id))
+        except OSError:
+            self.remove_client(client)
+
+    def add_observer(self, callback):
+        """Subscribes callback to user login and logout events. Callback is called
+        in server thread as callback(USER_LOGIN, name, ip, port, time) or callback(USER_LOGOUT, name).
+        """
+        self.observers.append(callback)
+
+    def notify(self, event, *args):
+        """Passes event to all observers."""
+        for callback in self.observers:
+            try:
+                callback(event, *args)
+            except Exception as err:
+                logger.error('Observer error: %s', err)
+
+    def deliver(self, message):
+        """Delivers message forwarded by another server node. If recipient
+        has gone, message is stored. Safe to call from another thread.
+        """
+        if threading.current_thread() is not self:
+            self.call_soon(self.deliver, message)
+            return
+        if message[DESTINATION] in self.names:
+            self.process_message(message)
+        elif self.database.check_user(message[DESTINATION]):
+            self.database.store_offline_message(message[SENDER], message[DESTINATION], text(message[MESSAGE_TEXT]))
+
+    def disconnect_user(self, name):
+        """Disconnects user by name. Safe to call from another thread."""
+        if threading.current_thread() is not self:
+            self.call_soon(self.disconnect_user, name)
+            return
+        if name in self.names:
+            self.remove_client(self.names[name])
+
+    def expire_auth(self):
+        """Disconnects clients which didn't answer challenge in time.
+        Deadlines are added in ascending order, so only expired head is checked.
+        """
+        now = time.monotonic()
+        expired = []
+        for sock, auth in self.pending_auth.items():
+            if auth[3] > now:
+                break
+            expired.append(sock)
+        for sock in expired:
+            logger.info('Client %s authorization timed out', self.clients[sock].address)
+            self.remove_client(sock)
 
     def service_update_lists(self):
-        """Updating clients list function."""
-        for client in self.names:
+        """Updating clients list function. Safe to call from another thread."""
+        if threading.current_thread() is not self:
+            self.call_soon(self.service_update_lists)
+            return
+        for client in list(self.names.values()):
             try:
-                send_message(self.names[client], RESPONSE_205)
+                self.send_to(client, ENCODED_205[self.client_codec(client)])
             except OSError:
-                self.remove_client(self.names[client])
+                self.remove_client(client)
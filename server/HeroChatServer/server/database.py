@@ -1,9 +1,14 @@
 """File contains classes for server database. Based on sqlalchemy ORM."""
 
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text
+from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text, bindparam, \
+    Index, event, inspect
 from sqlalchemy.orm import mapper, sessionmaker
 from common.variables import *
+from collections import namedtuple
 import datetime
+import time
+
+UserRecord = namedtuple('UserRecord', ['id', 'passwd_hash', 'pubkey'])
 
 
 class ServerStorage:
@@ -50,16 +55,27 @@ class ServerStorage:
             self.sent = 0
             self.accepted = 0
 
+    class OfflineMessages:
+        """Messages for offline users, waiting for delivery."""
+        def __init__(self, recipient, sender, message):
+            self.id = None
+            self.recipient = recipient
+            self.sender = sender
+            self.message = message
+            self.date = datetime.datetime.now()
+
     def __init__(self, path):
         self.database_engine = create_engine(f'sqlite:///{path}', echo=False, pool_recycle=7200,
                                              connect_args={'check_same_thread': False})
+        event.listen(self.database_engine, 'connect', self.set_sqlite_pragma)
         self.metadata = MetaData()
         users_table = Table('Users', self.metadata,
                             Column('id', Integer, primary_key=True),
                             Column('name', String, unique=True),
                             Column('last_login', DateTime),
                             Column('passwd_hash', String),
-                            Column('pubkey', Text))
+                            Column('pubkey', Text),
+                            Index('ix_users_last_login', 'last_login'))
         active_users_table = Table('Active_users', self.metadata,
                                    Column('id', Integer, primary_key=True),
                                    Column('user', ForeignKey('Users.id'), unique=True),
@@ -71,43 +87,94 @@ class ServerStorage:
                                    Column('name', ForeignKey('Users.id')),
                                    Column('date_time', DateTime),
                                    Column('ip', String),
-                                   Column('port', String))
+                                   Column('port', String),
+                                   Index('ix_login_history_name', 'name'))
         contacts = Table('Contacts', self.metadata,
                          Column('id', Integer, primary_key=True),
                          Column('user', ForeignKey('Users.id')),
-                         Column('contact', ForeignKey('Users.id')))
+                         Column('contact', ForeignKey('Users.id')),
+                         Index('ix_contacts_user_contact', 'user', 'contact'),
+                         Index('ix_contacts_contact', 'contact'))
         users_history_table = Table('History', self.metadata,
                                     Column('id', Integer, primary_key=True),
                                     Column('user', ForeignKey('Users.id')),
                                     Column('sent', Integer),
-                                    Column('accepted', Integer))
+                                    Column('accepted', Integer),
+                                    Index('ix_history_user', 'user'),
+                                    Index('ix_history_sent', 'sent'),
+                                    Index('ix_history_accepted', 'accepted'))
+        offline_messages_table = Table('Offline_messages', self.metadata,
+                                       Column('id', Integer, primary_key=True),
+                                       Column('recipient', ForeignKey('Users.id')),
+                                       Column('sender', String),
+                                       Column('message', Text),
+                                       Column('date', DateTime),
+                                       Index('ix_offline_messages_recipient', 'recipient', 'id'),
+                                       Index('ix_offline_messages_date', 'date'))
 
         self.metadata.create_all(self.database_engine)
+        self.migrate()
+        self.users_history_table = users_history_table
         mapper(self.AllUsers, users_table)
         mapper(self.ActiveUsers, active_users_table)
         mapper(self.LoginHistory, user_login_history)
         mapper(self.UsersContacts, contacts)
         mapper(self.UsersHistory, users_history_table)
+        mapper(self.OfflineMessages, offline_messages_table)
 
         Session = sessionmaker(bind=self.database_engine)
         self.session = Session()
         self.session.query(self.ActiveUsers).delete()
         self.session.commit()
 
+        self.reload_directory()
+
+        self.counters = dict()
+        self.counters_updates = 0
+        self.counters_flush_time = time.monotonic()
+
+    @staticmethod
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        """Applies performance settings to every new SQLite connection."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        cursor.execute(f'PRAGMA cache_size={SQLITE_CACHE_SIZE}')
+        cursor.close()
+
+    def migrate(self):
+        """Updates database created by older versions. Creates missing indexes."""
+        with self.database_engine.connect() as connection:
+            version = connection.execute('PRAGMA user_version').scalar()
+            if version >= SERVER_SCHEMA_VERSION:
+                return
+            inspector = inspect(connection)
+            created = False
+            for table in self.metadata.sorted_tables:
+                existing = {index['name'] for index in inspector.get_indexes(table.name)}
+                for index in table.indexes:
+                    if index.name not in existing:
+                        index.create(connection)
+                        created = True
+            if created:
+                connection.execute('ANALYZE')
+            connection.execute(f'PRAGMA user_version={SERVER_SCHEMA_VERSION}')
+
     def user_login(self, username, ip_address, port, key):
         """Login function."""
-        rez = self.session.query(self.AllUsers).filter_by(name=username)
-        if rez.count():
-            user = rez.first()
-            user.last_login = datetime.datetime.now()
-            if user.pubkey != key:
-                user.pubkey = key
-        else:
+        if username not in self.directory:
             raise ValueError('User is not registered')
+        user = self.directory[username]
+        login_time = datetime.datetime.now()
+        self.session.query(self.AllUsers).filter_by(id=user.id).update(
+            {self.AllUsers.last_login: login_time, self.AllUsers.pubkey: key}, synchronize_session=False)
+        if user.pubkey != key:
+            self.directory[username] = user._replace(pubkey=key)
 
-        new_active_user = self.ActiveUsers(user.id, ip_address, port, datetime.datetime.now())
+        new_active_user = self.ActiveUsers(user.id, ip_address, port, login_time)
         self.session.add(new_active_user)
-        history = self.LoginHistory(user.id, datetime.datetime.now(), ip_address, port)
+        history = self.LoginHistory(user.id, login_time, ip_address, port)
         self.session.add(history)
         self.session.commit()
 
@@ -119,55 +186,166 @@ class ServerStorage:
         history_row = self.UsersHistory(user_row.id)
         self.session.add(history_row)
         self.session.commit()
+        self.directory[name] = UserRecord(user_row.id, passwd_hash, None)
 
     def remove_user(self, name):
-        """DELETE user from all tables."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
-        self.session.query(self.LoginHistory).filter_by(name=user.id).delete()
-        self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
-        self.session.query(self.UsersContacts).filter_by(contact=user.id).delete()
-        self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
-        self.session.query(self.AllUsers).filter_by(name=name).delete()
+        """DELETE user from all tables. Session objects are not synchronized,
+        so time of delete doesn't depend on number of loaded users.
+        """
+        user = self.directory.pop(name)
+        self.counters.pop(user.id, None)
+        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete(synchronize_session=False)
+        self.session.query(self.LoginHistory).filter_by(name=user.id).delete(synchronize_session=False)
+        self.session.query(self.UsersContacts).filter_by(user=user.id).delete(synchronize_session=False)
+        self.session.query(self.UsersContacts).filter_by(contact=user.id).delete(synchronize_session=False)
+        self.session.query(self.UsersHistory).filter_by(user=user.id).delete(synchronize_session=False)
+        self.session.query(self.OfflineMessages).filter_by(recipient=user.id).delete(synchronize_session=False)
+        self.session.query(self.AllUsers).filter_by(id=user.id).delete(synchronize_session=False)
         self.session.commit()
 
+    def reload_directory(self):
+        """Loads users cache from database. Used when users
+        are changed by another process.
+        """
+        query = self.session.query(self.AllUsers.name, self.AllUsers.id,
+                                   self.AllUsers.passwd_hash, self.AllUsers.pubkey)
+        self.directory = {name: UserRecord(user_id, passwd_hash, pubkey)
+                          for name, user_id, passwd_hash, pubkey in query.all()}
+
+    def refresh_user(self, name):
+        """Loads one user to cache from database, e.g. after login on another server node.
+        Public key is taken only from database, key sent by another node is not trusted.
+        """
+        # Ends previous read transaction, so login saved by another process is seen.
+        self.session.commit()
+        user = self.session.query(self.AllUsers).filter_by(name=name).first()
+        if user:
+            self.directory[name] = UserRecord(user.id, user.passwd_hash, user.pubkey)
+        else:
+            self.directory.pop(name, None)
+
     def get_hash(self, name):
         """Getting password hash for user."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.passwd_hash
+        return self.directory[name].passwd_hash
 
     def get_pubkey(self, name):
         """Getting public key for user."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.pubkey
+        user = self.directory.get(name)
+        return user.pubkey if user else None
 
     def check_user(self, name):
         """Check existing user. Returns True or False."""
-        if self.session.query(self.AllUsers).filter_by(name=name).count():
-            return True
-        else:
-            return False
+        return name in self.directory
 
     def user_logout(self, username):
         """User logout function."""
-        user = self.session.query(self.AllUsers).filter_by(name=username).first()
+        user = self.directory.get(username)
+        if not user:
+            return
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
         self.session.commit()
 
     def process_message(self, sender, recipient):
-        """Adding history function."""
-        sender = self.session.query(self.AllUsers).filter_by(name=sender).first().id
-        recipient = self.session.query(self.AllUsers).filter_by(name=recipient).first().id
-        sender_row = self.session.query(self.UsersHistory).filter_by(user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(self.UsersHistory).filter_by(user=recipient).first()
-        recipient_row.accepted += 1
+        """Adding history function. Counters are collected in memory
+        and saved by 'flush_counters' in one transaction. Recipient
+        registered only on another server node is not counted.
+        """
+        self.process_messages(sender, (recipient, ))
+
+    def process_messages(self, sender, recipients):
+        """Counts messages from sender to every recipient of list."""
+        sender = self.directory[sender].id
+        self.counters.setdefault(sender, [0, 0])[0] += len(recipients)
+        for recipient in recipients:
+            if recipient in self.directory:
+                self.counters.setdefault(self.directory[recipient].id, [0, 0])[1] += 1
+        self.counters_updates += len(recipients)
+        if self.counters_updates >= COUNTERS_FLUSH_SIZE:
+            self.flush_counters()
+        else:
+            self.flush_counters(force=False)
+
+    def flush_counters(self, force=True):
+        """Saves collected message counters. Without 'force' saves them
+        only if flush interval has passed.
+        """
+        if not force and time.monotonic() - self.counters_flush_time < COUNTERS_FLUSH_INTERVAL:
+            return
+        counters = self.counters
+        self.counters = dict()
+        self.counters_updates = 0
+        self.counters_flush_time = time.monotonic()
+        if not counters:
+            return
+        table = self.users_history_table
+        self.session.execute(
+            table.update().where(table.c.user == bindparam('user_id')).values(
+                sent=table.c.sent + bindparam('sent_delta'),
+                accepted=table.c.accepted + bindparam('accepted_delta')),
+            [{'user_id': user_id, 'sent_delta': sent, 'accepted_delta': accepted}
+             for user_id, (sent, accepted) in counters.items()])
+        self.session.commit()
+
+    def store_offline_message(self, sender, recipient, message):
+        """Saves encrypted message for offline user. Keeps only
+        OFFLINE_MESSAGES_LIMIT newest messages for each user.
+        """
+        self.store_offline_messages(sender, ((recipient, message), ))
+
+    def store_offline_messages(self, sender, messages):
+        """Saves list of (recipient, encrypted message) in one transaction."""
+        recipients = set()
+        for recipient, message in messages:
+            recipient = self.directory[recipient].id
+            self.session.add(self.OfflineMessages(recipient, sender, message))
+            recipients.add(recipient)
+        self.session.flush()
+        for recipient in recipients:
+            kept = self.session.query(self.OfflineMessages.id).filter_by(recipient=recipient). \
+                order_by(self.OfflineMessages.id.desc()).limit(OFFLINE_MESSAGES_LIMIT).subquery()
+            self.session.query(self.OfflineMessages).filter(
+                self.OfflineMessages.recipient == recipient,
+                self.OfflineMessages.id.notin_(kept)).delete(synchronize_session=False)
         self.session.commit()
 
+    def get_offline_messages(self, username):
+        """Returns not expired messages for user as (id, sender, message, date).
+        Messages are kept until 'remove_offline_messages' is called after they are sent.
+        """
+        user = self.directory.get(username)
+        if not user:
+            return []
+        expire_date = datetime.datetime.now() - datetime.timedelta(seconds=OFFLINE_MESSAGE_TTL)
+        query = self.session.query(
+            self.OfflineMessages.id,
+            self.OfflineMessages.sender,
+            self.OfflineMessages.message,
+            self.OfflineMessages.date).filter(
+            self.OfflineMessages.recipient == user.id,
+            self.OfflineMessages.date >= expire_date).order_by(self.OfflineMessages.id)
+        return query.all()
+
+    def remove_offline_messages(self, username, last_id):
+        """Deletes messages for user up to last_id which have been sent."""
+        user = self.directory.get(username)
+        if not user:
+            return
+        self.session.query(self.OfflineMessages).filter(
+            self.OfflineMessages.recipient == user.id,
+            self.OfflineMessages.id <= last_id).delete(synchronize_session=False)
+        self.session.commit()
+
+    def remove_expired_messages(self):
+        """Deletes offline messages older than OFFLINE_MESSAGE_TTL."""
+        expire_date = datetime.datetime.now() - datetime.timedelta(seconds=OFFLINE_MESSAGE_TTL)
+        if self.session.query(self.OfflineMessages).filter(
+                self.OfflineMessages.date < expire_date).delete(synchronize_session=False):
+            self.session.commit()
+
     def add_contact(self, user, contact):
         """Add contact function."""
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(name=contact).first()
+        user = self.directory[user]
+        contact = self.directory.get(contact)
         if not contact or self.session.query(self.UsersContacts).filter_by(user=user.id, contact=contact.id).count():
             return
         contact_row = self.UsersContacts(user.id, contact.id)
@@ -176,8 +354,8 @@ class ServerStorage:
 
     def remove_contact(self, user, contact):
         """Delete contact function"""
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(name=contact).first()
+        user = self.directory[user]
+        contact = self.directory.get(contact)
         if not contact:
             return
         self.session.query(self.UsersContacts).filter(
@@ -211,18 +389,95 @@ class ServerStorage:
 
     def get_contacts(self, username):
         """Getting contacts list"""
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()
+        user = self.directory[username]
         query = self.session.query(self.UsersContacts, self.AllUsers.name). \
             filter_by(user=user.id). \
             join(self.AllUsers, self.UsersContacts.contact == self.AllUsers.id)
         return [contact[1] for contact in query.all()]
 
     def message_history(self):
-        """Getting all message history."""
+        """Getting all message history. Counters include not saved yet messages."""
         query = self.session.query(
+            self.AllUsers.id,
             self.AllUsers.name,
             self.AllUsers.last_login,
             self.UsersHistory.sent,
             self.UsersHistory.accepted
         ).join(self.AllUsers)
-        return query.all()
+        counters = self.counters
+        history = []
+        for user_id, name, last_login, sent, accepted in query.all():
+            sent_delta, accepted_delta = counters.get(user_id, (0, 0))
+            history.append((name, last_login, sent + sent_delta, accepted + accepted_delta))
+        return history
+
+    def message_history_page(self, offset, limit, column=0, descending=False, name_filter=''):
+        """Getting one page of message history sorted by column
+        (name, last login, sent, received) and filtered by beginning of name.
+        Counters are saved before the first page, so database sorts by actual values.
+        """
+        if offset == 0:
+            self.flush_counters()
+        columns = (self.AllUsers.name, self.AllUsers.last_login, self.UsersHistory.sent, self.UsersHistory.accepted)
+        query = self.session.query(self.AllUsers.id, *columns).join(self.AllUsers)
+        if name_filter:
+            # Range instead of LIKE, so unique index of names is used.
+            query = query.filter(self.AllUsers.name >= name_filter,
+                                 self.AllUsers.name < name_filter + '\U0010ffff')
+        # Second key makes order of equal values the same for every page.
+        # It is row id of the same table, so the whole order is read from index.
+        order = (columns[column], self.AllUsers.id if column < 2 else self.UsersHistory.id)
+        if descending:
+            order = [key.desc() for key in order]
+        query = query.order_by(*order).offset(offset).limit(limit)
+        counters = self.counters
+        history = []
+        for user_id, name, last_login, sent, accepted in query.all():
+            sent_delta, accepted_delta = counters.get(user_id, (0, 0))
+            history.append((name, last_login, sent + sent_delta, accepted + accepted_delta))
+        return history
+
+
+if __name__ == '__main__':
+    # get_contacts, login_history and remove_user on growing number of users.
+    # Every user has two contacts and two login history rows.
+    import os
+    import random
+    import tempfile
+    import timeit
+
+    bench_path = os.path.join(tempfile.gettempdir(), 'herochat_server_benchmark.db3')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(bench_path + suffix):
+            os.remove(bench_path + suffix)
+    bench_database = ServerStorage(bench_path)
+    tables = bench_database.metadata.tables
+    login_date = datetime.datetime(2020, 1, 1)
+    filled = 0
+    for users in (1000, 10000, 100000, 1000000):
+        new_ids = range(filled + 1, users + 1)
+        bench_database.session.execute(tables['Users'].insert(), [
+            {'id': i, 'name': f'user_{i}', 'last_login': login_date, 'passwd_hash': b'hash'} for i in new_ids])
+        bench_database.session.execute(tables['History'].insert(), [
+            {'user': i, 'sent': 0, 'accepted': 0} for i in new_ids])
+        bench_database.session.execute(tables['Contacts'].insert(), [
+            {'user': i, 'contact': (i + shift) % users + 1} for i in new_ids for shift in (1, 2)])
+        bench_database.session.execute(tables['Login_history'].insert(), [
+            {'name': i, 'date_time': login_date, 'ip': '127.0.0.1', 'port': '7777'} for i in new_ids for j in (1, 2)])
+        bench_database.session.commit()
+        bench_database.reload_directory()
+        filled = users
+        number = 200
+        names = random.sample(list(bench_database.directory), number)
+        contacts = timeit.timeit(lambda: bench_database.get_contacts(names.pop()), number=number)
+        names = random.sample(list(bench_database.directory), number)
+        history = timeit.timeit(lambda: bench_database.login_history(names.pop()), number=number)
+        names = list(bench_database.directory)[-number:]
+        remove = timeit.timeit(lambda: bench_database.remove_user(names.pop()), number=number)
+        print(f'{users} users: get_contacts {contacts / number * 1e3:.2f} ms, '
+              f'login_history {history / number * 1e3:.2f} ms, remove_user {remove / number * 1e3:.2f} ms')
+    bench_database.session.close()
+    bench_database.database_engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(bench_path + suffix):
+            os.remove(bench_path + suffix)
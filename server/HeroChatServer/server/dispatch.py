@@ -0,0 +1,79 @@
+"""File contains client message schemas used by server dispatch tables."""
+
+from common.variables import *
+
+# Action: (required fields, field which must contain name of session user or None).
+MESSAGE_SCHEMAS = {
+    PRESENCE: ((TIME, USER), None),
+    MESSAGE: ((DESTINATION, TIME, SENDER, MESSAGE_TEXT), SENDER),
+    MESSAGE_BATCH: ((TIME, SENDER, MESSAGES), SENDER),
+    EXIT: ((ACCOUNT_NAME, ), ACCOUNT_NAME),
+    GET_CONTACTS: ((USER, ), USER),
+    ADD_CONTACT: ((ACCOUNT_NAME, USER), USER),
+    REMOVE_CONTACT: ((ACCOUNT_NAME, USER), USER),
+    USERS_REQUEST: ((ACCOUNT_NAME, ), ACCOUNT_NAME),
+    PUBLIC_KEY_REQUEST: ((ACCOUNT_NAME, ), None),
+}
+
+
+def message_action(message, name):
+    """Checks message against schema of its action. Returns action
+    or None if action is unknown or message is incorrect.
+    """
+    action = message.get(ACTION)
+    schema = MESSAGE_SCHEMAS.get(action)
+    if schema is None:
+        return None
+    fields, owner = schema
+    for field in fields:
+        if field not in message:
+            return None
+    if owner and message[owner] != name:
+        return None
+    return action
+
+
+def batch_messages(batch):
+    """Returns MESSAGE dictionaries of MESSAGE_BATCH entries [destination, text]
+    with None for incorrect entry, or None if batch is incorrect or too long.
+    Text must be string or bytes, so every entry can be stored.
+    """
+    entries = batch[MESSAGES]
+    if not isinstance(entries, list) or len(entries) > MESSAGE_BATCH_LIMIT:
+        return None
+    messages = []
+    for entry in entries:
+        if isinstance(entry, list) and len(entry) == 2 and isinstance(entry[0], str) \
+                and isinstance(entry[1], (str, bytes)):
+            messages.append({ACTION: MESSAGE, SENDER: batch[SENDER], DESTINATION: entry[0],
+                             TIME: batch[TIME], MESSAGE_TEXT: entry[1]})
+        else:
+            messages.append(None)
+    return messages
+
+
+if __name__ == '__main__':
+    # Dispatch overhead: schema check and handler lookup for every action.
+    import timeit
+
+    handlers = dict.fromkeys(MESSAGE_SCHEMAS, lambda message: None)
+    samples = {
+        PRESENCE: {ACTION: PRESENCE, TIME: 1.0, USER: {ACCOUNT_NAME: 'user_1', PUBLIC_KEY: ''}},
+        MESSAGE: {ACTION: MESSAGE, SENDER: 'user_1', DESTINATION: 'user_2', TIME: 1.0, MESSAGE_TEXT: 'text'},
+        MESSAGE_BATCH: {ACTION: MESSAGE_BATCH, SENDER: 'user_1', TIME: 1.0, MESSAGES: [['user_2', 'text']]},
+        EXIT: {ACTION: EXIT, TIME: 1.0, ACCOUNT_NAME: 'user_1'},
+        GET_CONTACTS: {ACTION: GET_CONTACTS, TIME: 1.0, USER: 'user_1'},
+        ADD_CONTACT: {ACTION: ADD_CONTACT, TIME: 1.0, USER: 'user_1', ACCOUNT_NAME: 'user_2'},
+        REMOVE_CONTACT: {ACTION: REMOVE_CONTACT, TIME: 1.0, USER: 'user_1', ACCOUNT_NAME: 'user_2'},
+        USERS_REQUEST: {ACTION: USERS_REQUEST, TIME: 1.0, ACCOUNT_NAME: 'user_1'},
+        PUBLIC_KEY_REQUEST: {ACTION: PUBLIC_KEY_REQUEST, TIME: 1.0, ACCOUNT_NAME: 'user_2'},
+        'unknown': {ACTION: 'unknown', TIME: 1.0},
+    }
+    number = 100000
+    for action, message in samples.items():
+        def dispatch():
+            handler = handlers.get(message_action(message, 'user_1'))
+            if handler:
+                handler(message)
+        seconds = timeit.timeit(dispatch, number=number)
+        print(f'{action}: {seconds / number * 1e6:.2f} us per message')
@@ -3,16 +3,93 @@
 import sys
 import os
 from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QApplication, QLabel, QTableView
-from PyQt5.QtGui import QStandardItemModel, QStandardItem
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt, pyqtSignal, pyqtSlot
 from server.stat_window import StatWindow
 from server.config_window import ConfigWindow
 from server.add_user import RegisterUser
 from server.remove_user import DelUserDialog
+from common.variables import USER_LOGIN, USER_LOGOUT
 
 sys.path.append('../')
 
 
+class ActiveUsersModel(QAbstractTableModel):
+    """Table of active users. Changed by login and logout events of server,
+    events from server thread come to GUI thread through signals.
+    """
+    headers = ('Username', 'IPv4 address', 'Port', 'Time')
+    user_logged_in = pyqtSignal(str, str, int, object)
+    user_logged_out = pyqtSignal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.users = []
+        self.rows = dict()
+        self.user_logged_in.connect(self.add_user)
+        self.user_logged_out.connect(self.remove_user)
+
+    def server_event(self, event, *args):
+        """Server observer. Safe to call from any thread."""
+        if event == USER_LOGIN:
+            self.user_logged_in.emit(*args)
+        elif event == USER_LOGOUT:
+            self.user_logged_out.emit(*args)
+
+    def reset_users(self, users):
+        """Replaces all rows with list of (name, ip, port, time)."""
+        self.beginResetModel()
+        self.users = [list(user) for user in users]
+        self.rows = {user[0]: row for row, user in enumerate(self.users)}
+        self.endResetModel()
+
+    @pyqtSlot(str, str, int, object)
+    def add_user(self, name, ip, port, time):
+        row = self.rows.get(name)
+        if row is not None:
+            self.users[row] = [name, ip, port, time]
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.headers) - 1))
+            return
+        row = len(self.users)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.users.append([name, ip, port, time])
+        self.rows[name] = row
+        self.endInsertRows()
+
+    @pyqtSlot(str)
+    def remove_user(self, name):
+        """Removes user row. The last row is moved to its place, so removing costs the same for any table size."""
+        row = self.rows.pop(name, None)
+        if row is None:
+            return
+        last = len(self.users) - 1
+        if row != last:
+            self.users[row] = self.users[last]
+            self.rows[self.users[row][0]] = row
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.headers) - 1))
+        self.beginRemoveRows(QModelIndex(), last, last)
+        self.users.pop()
+        self.endRemoveRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.users)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        value = self.users[index.row()][index.column()]
+        if index.column() == 3:
+            return str(value.replace(microsecond=0))
+        return str(value)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+
 class MainWindow(QMainWindow):
     """Basis constructor. Based on QMainWindow."""
     def __init__(self, database, server, config):
@@ -58,9 +135,10 @@ class MainWindow(QMainWindow):
         self.active_clients_table.move(10, 45)
         self.active_clients_table.setFixedSize(780, 400)
 
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.create_users_model)
-        self.timer.start(1000)
+        self.users_model = ActiveUsersModel()
+        self.active_clients_table.setModel(self.users_model)
+        self.server_thread.add_observer(self.users_model.server_event)
+        self.create_users_model()
 
         self.refresh_button.triggered.connect(self.create_users_model)
         self.show_history_button.triggered.connect(self.show_statistics)
@@ -71,24 +149,9 @@ class MainWindow(QMainWindow):
         self.show()
 
     def create_users_model(self):
-        """Creates table with users."""
-        list_users = self.database.active_users_list()
-        list = QStandardItemModel()
-        list.setHorizontalHeaderLabels(['Username', 'IPv4 address', 'Port', 'Time'])
-        for row in list_users:
-            user, ip, port, time = row
-            user = QStandardItem(user)
-            user.setEditable(False)
-            ip = QStandardItem(ip)
-            ip.setEditable(False)
-            port = QStandardItem(str(port))
-            port.setEditable(False)
-            time = QStandardItem(str(time.replace(microsecond=0)))
-            time.setEditable(False)
-            list.appendRow([user, ip, port, time])
-        self.active_clients_table.setModel(list)
+        """Loads active users from database. Later changes come from server events."""
+        self.users_model.reset_users(self.database.active_users_list().result())
         self.active_clients_table.resizeColumnsToContents()
-        self.active_clients_table.resizeRowsToContents()
 
     def show_statistics(self):
         """Shows statistics for users."""
@@ -0,0 +1,290 @@
+"""File contains relay between server nodes: worker processes of one server
+or servers of cluster. Every node listens for links from peers and keeps
+one outgoing link to every peer. Nodes announce users who logged in and out,
+so each node knows where user is online, and forward messages for users
+of other nodes through links. After link is (re)established node sends
+all its users to peer, so directories are restored after network errors.
+Node which accepts link sends random challenge, peer answers with its HMAC
+by shared secret, so secret itself is never sent.
+"""
+
+import threading
+import logging
+import socket
+import queue
+import hmac
+import hashlib
+import time
+import os
+import binascii
+from common.variables import *
+from common.errors import IncorrectDataRecivedError
+from common.utils import encode_message, get_message, socket_buffers, MessageBuffer, data_response
+
+logger = logging.getLogger('server')
+
+
+def open_link(address):
+    """Creates socket connected to relay address: path of Unix socket or (host, port)."""
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class RelayLink(threading.Thread):
+    """Outgoing link to peer node. Frames are sent from queue in link thread,
+    so server thread never waits for peer. Link is restored after errors.
+    """
+    def __init__(self, relay, node, address):
+        super().__init__()
+        self.daemon = True
+        self.relay = relay
+        self.node = node
+        self.address = address
+        self.frames = queue.Queue(RELAY_QUEUE_SIZE)
+
+    def send(self, message):
+        """Puts message to link queue. Message is dropped if queue is full."""
+        try:
+            self.frames.put_nowait(encode_message(message))
+        except queue.Full:
+            logger.error('Relay queue to node %s is full, message has been dropped', self.node)
+
+    def run(self):
+        while self.relay.running:
+            try:
+                sock = open_link(self.address)
+            except OSError:
+                time.sleep(RELAY_RETRY_INTERVAL)
+                continue
+            try:
+                socket_buffers[sock] = MessageBuffer(limit=MAX_REQUEST_LENGTH)
+                sock.settimeout(AUTH_TIMEOUT)
+                challenge = get_message(sock)
+                sock.settimeout(None)
+                sock.sendall(b''.join(encode_message(message) for message in self.relay.greeting(challenge[DATA])))
+            except (OSError, ValueError, TypeError, KeyError, IncorrectDataRecivedError):
+                sock.close()
+                time.sleep(RELAY_RETRY_INTERVAL)
+                continue
+            logger.info('Relay link to node %s is established', self.node)
+            with sock:
+                while True:
+                    frame = self.frames.get()
+                    if frame is None:
+                        return
+                    try:
+                        sock.sendall(frame)
+                    except OSError:
+                        logger.error('Relay link to node %s has been lost', self.node)
+                        break
+
+    def stop(self):
+        self.frames.put(None)
+
+
+class Relay:
+    """Relay of server node. 'address' is path of Unix socket or (host, port)
+    to listen for peers, 'peers' is dictionary {node: address}. Peers must know
+    the same 'secret'. Server calls 'locate', 'forward', 'user_online' and
+    'user_offline' from its thread, messages for local users are passed to 'server.deliver'.
+    """
+    def __init__(self, node, address, peers, secret):
+        self.node = node
+        self.address = address
+        self.secret = secret
+        self.server = None
+        self.running = False
+        self.sock = None
+        self.directory = dict()
+        self.pubkeys = dict()
+        self.links = {peer: RelayLink(self, peer, peer_address) for peer, peer_address in peers.items()}
+
+    def start(self, server):
+        """Starts listening for peers and connecting to them."""
+        self.server = server
+        self.running = True
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(MAX_CONNECTIONS)
+        threading.Thread(target=self.accept_links, daemon=True).start()
+        for link in self.links.values():
+            link.start()
+
+    def stop(self):
+        """Closes listening socket and outgoing links."""
+        self.running = False
+        for link in self.links.values():
+            link.stop()
+        if self.sock:
+            self.sock.close()
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.remove(self.address)
+
+    def sign(self, challenge):
+        """Returns HMAC of challenge by shared secret."""
+        return hmac.new(self.secret.encode(ENCODING), challenge.encode(ENCODING), hashlib.sha256).hexdigest()
+
+    def greeting(self, challenge):
+        """Messages sent to peer after link is established: node name with answer
+        for challenge and local users.
+        """
+        yield {ACTION: RELAY_HELLO, NODE: self.node, DATA: self.sign(challenge)}
+        for name in list(self.server.names):
+            yield {ACTION: RELAY_ONLINE, NODE: self.node, USER: name,
+                   PUBLIC_KEY: self.server.database.get_pubkey(name)}
+
+    def broadcast(self, message):
+        for link in self.links.values():
+            link.send(message)
+
+    def locate(self, name):
+        """Returns node where user is online or None."""
+        return self.directory.get(name)
+
+    def get_pubkey(self, name):
+        """Returns public key of user online on another node."""
+        return self.pubkeys.get(name) if name in self.directory else None
+
+    def forward(self, message):
+        """Sends message to node of recipient."""
+        link = self.links.get(self.directory.get(message[DESTINATION]))
+        if link:
+            link.send(message)
+
+    def user_online(self, name, pubkey):
+        self.broadcast({ACTION: RELAY_ONLINE, NODE: self.node, USER: name, PUBLIC_KEY: pubkey})
+
+    def user_offline(self, name):
+        self.broadcast({ACTION: RELAY_OFFLINE, NODE: self.node, USER: name})
+
+    def accept_links(self):
+        while self.running:
+            try:
+                sock, address = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.read_link, args=(sock, ), daemon=True).start()
+
+    def read_link(self, sock):
+        """Reads frames from peer. Peer must answer challenge with HMAC by shared secret.
+        Frames longer than MAX_REQUEST_LENGTH are accepted only after that.
+        """
+        node = None
+        socket_buffers[sock] = MessageBuffer(limit=MAX_REQUEST_LENGTH)
+        with sock:
+            try:
+                challenge = binascii.hexlify(os.urandom(32)).decode('ascii')
+                sock.settimeout(AUTH_TIMEOUT)
+                sock.sendall(encode_message(data_response(challenge)))
+                hello = get_message(sock)
+                sock.settimeout(None)
+                if hello.get(ACTION) != RELAY_HELLO or not isinstance(hello.get(DATA), str) \
+                        or not hmac.compare_digest(hello[DATA].encode(ENCODING), self.sign(challenge).encode(ENCODING)):
+                    logger.error('Relay link with wrong secret has been rejected')
+                    return
+                node = hello[NODE]
+                socket_buffers[sock].limit = MAX_RELAY_LENGTH
+                while self.running:
+                    self.process_relay_message(node, get_message(sock))
+            except IncorrectDataRecivedError:
+                logger.error('Relay link from node %s has sent too long frame', node)
+            except (OSError, ValueError, TypeError, KeyError):
+                pass
+            finally:
+                if node is not None:
+                    for name in [name for name, user_node in list(self.directory.items()) if user_node == node]:
+                        del self.directory[name]
+                        self.pubkeys.pop(name, None)
+                    logger.info('Relay link from node %s has been closed', node)
+
+    def process_relay_message(self, node, message):
+        if message[ACTION] == MESSAGE:
+            self.server.deliver(message)
+        elif message[ACTION] == RELAY_ONLINE:
+            self.directory[message[USER]] = node
+            self.pubkeys[message[USER]] = message.get(PUBLIC_KEY)
+            self.server.database.refresh_user(message[USER])
+        elif message[ACTION] == RELAY_OFFLINE:
+            if self.directory.get(message[USER]) == node:
+                del self.directory[message[USER]]
+                self.pubkeys.pop(message[USER], None)
+
+
+def parse_address(address):
+    """Converts 'host:port' string to (host, port) tuple."""
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def relay_from_config(config):
+    """Creates relay of cluster node from CLUSTER section of server config
+    or returns None if server is not a cluster node.
+    Peers are listed as 'name=host:port' separated by commas.
+    """
+    if 'CLUSTER' not in config:
+        return None
+    section = config['CLUSTER']
+    peers = dict()
+    for peer in section.get('Peers', '').split(','):
+        if peer.strip():
+            name, address = peer.split('=', 1)
+            peers[name.strip()] = parse_address(address.strip())
+    return Relay(section['Node'], parse_address(section['Address']), peers, section['Key'])
+
+
+if __name__ == '__main__':
+    # Cross-node relay latency: message forwarded by node 'a' is delivered by node 'b'.
+    import statistics
+
+    class BenchServer:
+        def __init__(self):
+            self.names = dict()
+            self.database = self
+            self.delivered = queue.Queue()
+
+        def get_pubkey(self, name):
+            return None
+
+        def refresh_user(self, name):
+            pass
+
+        def deliver(self, message):
+            self.delivered.put(time.perf_counter())
+
+    secret = binascii.hexlify(os.urandom(16)).decode('ascii')
+    node_a = Relay('a', ('127.0.0.1', 18401), {'b': ('127.0.0.1', 18402)}, secret)
+    node_b = Relay('b', ('127.0.0.1', 18402), {'a': ('127.0.0.1', 18401)}, secret)
+    server_a, server_b = BenchServer(), BenchServer()
+    node_a.start(server_a)
+    node_b.start(server_b)
+    server_b.names['user_2'] = None
+    node_b.user_online('user_2', 'key')
+    while not node_a.locate('user_2'):
+        time.sleep(0.01)
+    bench_message = {ACTION: MESSAGE, SENDER: 'user_1', DESTINATION: 'user_2', TIME: 1.0,
+                     MESSAGE_TEXT: os.urandom(256)}
+    latencies = []
+    for i in range(2000):
+        start = time.perf_counter()
+        node_a.forward(bench_message)
+        latencies.append(server_b.delivered.get() - start)
+    latencies.sort()
+    print(f'Relay latency: median {statistics.median(latencies) * 1e6:.0f} us, '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} us')
+    node_a.stop()
+    node_b.stop()
@@ -39,14 +39,11 @@ class DelUserDialog(QDialog):
 
     def all_users_fill(self):
         """Fills a selector object with users from contacts."""
-        self.selector.addItems([item[0] for item in self.database.users_list()])
+        self.selector.addItems([item[0] for item in self.database.users_list().result()])
 
     def remove_user(self):
         """Deleting chosen user."""
-        self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
+        self.database.remove_user(self.selector.currentText()).result()
+        self.server.disconnect_user(self.selector.currentText())
         self.server.service_update_lists()
         self.close()
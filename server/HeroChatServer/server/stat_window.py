@@ -1,9 +1,76 @@
 """File contains a class for statistics window. Based on PyQt5 QDialog."""
 
 
-from PyQt5.QtWidgets import QDialog, QPushButton, QTableView
-from PyQt5.QtGui import QStandardItemModel, QStandardItem
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDialog, QPushButton, QTableView, QLineEdit, QHeaderView
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt
+from common.variables import STAT_PAGE_SIZE
+
+
+class StatModel(QAbstractTableModel):
+    """Message statistics loaded from database page by page while table is scrolled.
+    Sorting and filtering are done by database queries.
+    """
+    headers = ('Username', 'Last time log in', 'Messages send', 'Messages received')
+
+    def __init__(self, database):
+        super().__init__()
+        self.database = database
+        self.rows = []
+        self.exhausted = True
+        self.column = 0
+        self.descending = False
+        self.name_filter = ''
+
+    def reload(self):
+        """Drops loaded rows and loads the first page."""
+        self.beginResetModel()
+        self.rows = []
+        self.exhausted = False
+        self.endResetModel()
+        self.fetchMore()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.column = column
+        self.descending = order == Qt.DescendingOrder
+        self.reload()
+
+    def set_filter(self, text):
+        """Shows only users whose names begin with text."""
+        self.name_filter = text
+        self.reload()
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        page = self.database.message_history_page(
+            len(self.rows), STAT_PAGE_SIZE, self.column, self.descending, self.name_filter).result()
+        self.exhausted = len(page) < STAT_PAGE_SIZE
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(page) - 1)
+            self.rows.extend(page)
+            self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        value = self.rows[index.row()][index.column()]
+        if index.column() == 1:
+            return str(value.replace(microsecond=0))
+        return str(value)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
 
 
 class StatWindow(QDialog):
@@ -23,29 +90,25 @@ class StatWindow(QDialog):
         self.close_button.move(250, 650)
         self.close_button.clicked.connect(self.close)
 
+        self.filter_edit = QLineEdit(self)
+        self.filter_edit.move(10, 10)
+        self.filter_edit.setFixedSize(580, 25)
+        self.filter_edit.setPlaceholderText('Filter by username')
+
         self.stat_table = QTableView(self)
-        self.stat_table.move(10, 10)
-        self.stat_table.setFixedSize(580, 620)
+        self.stat_table.move(10, 45)
+        self.stat_table.setFixedSize(580, 585)
 
         self.create_stat_model()
 
     def create_stat_model(self):
-        """Creating a table with statistics."""
-        stat_list = self.database.message_history()
-        list = QStandardItemModel()
-        list.setHorizontalHeaderLabels(
-            ['Username', 'Last time log in', 'Messages send', 'Messages received'])
-        for row in stat_list:
-            user, last_seen, sent, recvd = row
-            user = QStandardItem(user)
-            user.setEditable(False)
-            last_seen = QStandardItem(str(last_seen.replace(microsecond=0)))
-            last_seen.setEditable(False)
-            sent = QStandardItem(str(sent))
-            sent.setEditable(False)
-            recvd = QStandardItem(str(recvd))
-            recvd.setEditable(False)
-            list.appendRow([user, last_seen, sent, recvd])
-        self.stat_table.setModel(list)
-        self.stat_table.resizeColumnsToContents()
-        self.stat_table.resizeRowsToContents()
+        """Creating a table with statistics. Rows are loaded by pages,
+        so columns are not resized to contents.
+        """
+        self.stat_model = StatModel(self.database)
+        self.stat_table.setModel(self.stat_model)
+        self.stat_table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.stat_table.horizontalHeader().setSortIndicator(0, Qt.AscendingOrder)
+        # Enabling of sorting sorts model, the first page is loaded here.
+        self.stat_table.setSortingEnabled(True)
+        self.filter_edit.textChanged.connect(self.stat_model.set_filter)
@@ -0,0 +1,75 @@
+"""File contains database worker thread. The only thread which works with ServerStorage session."""
+
+import threading
+import queue
+import logging
+from concurrent.futures import Future
+from server.database import ServerStorage
+from common.variables import COUNTERS_FLUSH_INTERVAL
+
+logger = logging.getLogger('server')
+
+
+class StorageWorker(threading.Thread):
+    """Database worker. Any ServerStorage method called on worker is put to command queue
+    and executed in worker thread in order, call returns concurrent.futures.Future with result.
+    Directory lookups are answered from memory at once and return plain values.
+    """
+    direct_methods = ('check_user', 'get_hash', 'get_pubkey')
+
+    def __init__(self, path):
+        super().__init__()
+        self.daemon = True
+        self.storage = ServerStorage(path)
+        self.commands = queue.Queue()
+
+    def __getattr__(self, name):
+        """Returns function which submits storage method call to worker."""
+        if 'storage' not in self.__dict__:
+            raise AttributeError(name)
+        method = getattr(self.__dict__['storage'], name)
+        if name in self.direct_methods:
+            return method
+        return lambda *args: self.submit(method, *args)
+
+    def submit(self, method, *args):
+        """Puts command to queue. Returns Future with command result."""
+        future = Future()
+        self.commands.put((future, method, args))
+        return future
+
+    def run(self):
+        """Executes commands one by one. Saves message counters
+        and deletes expired offline messages while idle.
+        """
+        while True:
+            try:
+                command = self.commands.get(timeout=COUNTERS_FLUSH_INTERVAL)
+            except queue.Empty:
+                self.execute(self.storage.flush_counters, (False, ))
+                self.execute(self.storage.remove_expired_messages, ())
+                continue
+            if command is None:
+                break
+            future, method, args = command
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(method(*args))
+                except Exception as err:
+                    logger.error('Database error in %s: %s', method.__name__, err)
+                    self.storage.session.rollback()
+                    future.set_exception(err)
+        self.execute(self.storage.flush_counters, ())
+
+    def execute(self, method, args):
+        """Executes command without Future. Errors are logged."""
+        try:
+            method(*args)
+        except Exception as err:
+            logger.error('Database error in %s: %s', method.__name__, err)
+            self.storage.session.rollback()
+
+    def stop(self):
+        """Stops worker after all queued commands are executed."""
+        self.commands.put(None)
+        self.join()
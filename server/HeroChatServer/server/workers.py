@@ -0,0 +1,130 @@
+"""File contains multi-process server mode. Every worker process has its own
+storage worker and server thread which accepts connections on the same port
+(SO_REUSEPORT). Workers are linked by relay through Unix sockets, so message
+is delivered to recipient connected to any worker.
+"""
+
+import multiprocessing
+import tempfile
+import threading
+import binascii
+import logging
+import socket
+import os
+
+logger = logging.getLogger('server')
+
+
+def reuse_port_supported():
+    """Checks that OS can share listening port between processes."""
+    return hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'AF_UNIX')
+
+
+def worker_main(index, listen_address, listen_port, database_path, async_flag, relay_addresses, secret, commands):
+    """Entry point of worker process. Runs server until stop command."""
+    from server.core import MessageProcessor
+    from server.async_core import AsyncMessageProcessor
+    from server.storage_worker import StorageWorker
+    from server.relay import Relay
+
+    database = StorageWorker(database_path)
+    database.start()
+    peers = {str(peer): address for peer, address in enumerate(relay_addresses) if peer != index}
+    relay = Relay(str(index), relay_addresses[index], peers, secret)
+    engine = AsyncMessageProcessor if async_flag else MessageProcessor
+    server = engine(listen_address, listen_port, database, relay=relay, reuse_port=True)
+    server.daemon = True
+    server.add_observer(lambda *event: commands.send(event))
+    server.start()
+    relay.start(server)
+    while True:
+        try:
+            command = commands.recv()
+        except (EOFError, OSError):
+            break
+        if command[0] == 'update_lists':
+            database.reload_directory()
+            server.service_update_lists()
+        elif command[0] == 'disconnect':
+            database.reload_directory()
+            server.disconnect_user(command[1])
+        elif command[0] == 'stop':
+            break
+    relay.stop()
+    server.stop()
+    server.join()
+    database.stop()
+
+
+class WorkerPool:
+    """Runs server in several processes. Has the same control methods as
+    MessageProcessor, so GUI works with it as with server object.
+    """
+    def __init__(self, listen_address, listen_port, database_path, workers, async_flag=False):
+        self.addr = listen_address
+        self.port = listen_port
+        self.database_path = database_path
+        self.workers = workers
+        self.async_flag = async_flag
+        self.processes = []
+        self.commands = []
+        self.observers = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Starts worker processes."""
+        context = multiprocessing.get_context('spawn')
+        relay_addresses = [os.path.join(tempfile.gettempdir(), f'herochat-{self.port}-{index}.sock')
+                           for index in range(self.workers)]
+        secret = binascii.hexlify(os.urandom(16)).decode('ascii')
+        for index in range(self.workers):
+            parent_end, child_end = context.Pipe()
+            process = context.Process(target=worker_main, daemon=True,
+                                      args=(index, self.addr, int(self.port), self.database_path,
+                                            self.async_flag, relay_addresses, secret, child_end))
+            process.start()
+            self.processes.append(process)
+            self.commands.append(parent_end)
+            threading.Thread(target=self.read_events, args=(parent_end, ), daemon=True).start()
+        logger.info('Server is running in %s worker processes', self.workers)
+
+    def add_observer(self, callback):
+        """Subscribes callback to user login and logout events of all workers.
+        Callback is called in event reader thread.
+        """
+        self.observers.append(callback)
+
+    def read_events(self, connection):
+        """Passes events sent by worker to observers until worker exits."""
+        while True:
+            try:
+                event = connection.recv()
+            except (EOFError, OSError):
+                return
+            for callback in self.observers:
+                callback(*event)
+
+    def send_command(self, *command):
+        with self.lock:
+            for connection in self.commands:
+                try:
+                    connection.send(command)
+                except OSError:
+                    pass
+
+    def service_update_lists(self):
+        """Asks workers to reload users and send update message to clients."""
+        self.send_command('update_lists')
+
+    def disconnect_user(self, name):
+        """Asks workers to disconnect user."""
+        self.send_command('disconnect', name)
+
+    def stop(self):
+        self.send_command('stop')
+
+    def join(self, timeout=5):
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()